@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from .authentication import forget_saved_user
+        from .metrics import install_query_timer
+        from .search import ensure_sqlite_triggers
+        post_migrate.connect(ensure_sqlite_triggers, sender=self)
+        connection_created.connect(install_query_timer)
+        for model in (User, self.get_model('Profile')):
+            post_save.connect(forget_saved_user, sender=model)
+            post_delete.connect(forget_saved_user, sender=model)
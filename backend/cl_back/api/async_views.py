@@ -0,0 +1,242 @@
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated, ParseError, ValidationError
+from rest_framework.renderers import JSONRenderer
+
+from .authentication import CachedJWTAuthentication
+from .events import get_event_broker
+from .mixins import version_etag
+from .models import Category, Note, UserVersion
+from .presence import aget_presence_stats, get_presence_store
+from .serializers import CategorySerializer, NoteSerializer, nest_notes
+from .views import (
+    SYNC_COMMIT_MARGIN, NoteListCreate, filter_by_category, note_changes, parse_sync_cursor, visitor_id_error,
+)
+
+
+def json_response(data, status_code=status.HTTP_200_OK, headers=None):
+    # DRF's renderer, so the bytes match what the sync views send
+    return HttpResponse(JSONRenderer().render(data), status=status_code, headers=headers, content_type='application/json')
+
+
+async def authenticate(request):
+    """CachedJWTAuthentication for async views.
+
+    Returns AnonymousUser when there is no bearer token and raises
+    AuthenticationFailed for a bad token or an unknown or inactive user.
+    """
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        return AnonymousUser()
+    token = authentication.get_validated_token(raw_token)
+    # One thread hop for the cache, on a miss the query, and simplejwt's checks; a shared cache blocks on the network
+    return await sync_to_async(authentication.get_user)(token)
+
+
+class AsyncAPIView(View):
+    """Async counterpart of the parts of DRF's APIView these endpoints use.
+
+    JWT authentication, JSON errors shaped like DRF's exception handler and
+    CSRF exemption. Routed with SERVER_MODE=asgi only; blocking cache and
+    database work is handed to a thread.
+    """
+    authentication_required = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await authenticate(request)
+            if self.authentication_required and not request.user.is_authenticated:
+                raise NotAuthenticated()
+            response = await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            data = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            response = json_response(data, exc.status_code)
+            if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+                response['WWW-Authenticate'] = 'Bearer realm="api"'
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def parse_body(self, request):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body or b'{}')
+            except ValueError as exc:
+                raise ParseError(f'JSON parse error - {exc}')
+            if not isinstance(data, dict):
+                raise ParseError('Expected a JSON object.')
+            return data
+        return request.POST
+
+
+class PresenceHeartbeat(AsyncAPIView):
+    async def post(self, request, *args, **kwargs):
+        data = self.parse_body(request)
+        visitor_id = data.get('visitor_id')
+        user_agent = request.headers.get('User-Agent', '')[:255]
+        ip_address = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0] or request.META.get('REMOTE_ADDR')
+
+        error = visitor_id_error(visitor_id)
+        if error is not None:
+            return json_response({"error": error}, status.HTTP_400_BAD_REQUEST)
+
+        user_id = request.user.id if request.user.is_authenticated else None
+        await get_presence_store().arecord(visitor_id, user_id, user_agent, ip_address)
+
+        return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+
+class PresenceStats(AsyncAPIView):
+    ONLINE_WINDOW_SECONDS = 60
+
+    async def get(self, request, *args, **kwargs):
+        return json_response(await aget_presence_stats(self.ONLINE_WINDOW_SECONDS))
+
+
+class NoteList(AsyncAPIView):
+    """The notes list on the async ORM.
+
+    Plain and ``?format=tree`` reads are served here, with the same ETag as
+    NoteListCreate. Writes, paginated reads and the browsable API are handed
+    to NoteListCreate in a worker thread.
+    """
+    authentication_required = True
+    sync_view = staticmethod(NoteListCreate.as_view())
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or not self.served_async(request):
+            return await sync_to_async(self.sync_view)(request, *args, **kwargs)
+        return await super().dispatch(request, *args, **kwargs)
+
+    def served_async(self, request):
+        params = request.GET
+        return (
+            'limit' not in params and 'cursor' not in params
+            and params.get('format') in (None, 'json', 'tree')
+            and 'text/html' not in request.headers.get('Accept', '')
+        )
+
+    async def get(self, request, *args, **kwargs):
+        etag = version_etag(request, request.user.id, await UserVersion.acurrent(request.user.id))
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        notes = Note.objects.in_active_categories().filter(author=request.user, archived_at__isnull=True)
+        notes = filter_by_category(notes, request.GET)
+
+        rows = await NoteSerializer.aserialize_values(notes.order_by('root_order', 'tree_id', 'lft'))
+        if request.GET.get('format') == 'tree':
+            rows = nest_notes(rows)
+        return json_response(rows, headers={'ETag': etag})
+
+
+class SentChanges:
+    """What an event stream sent within the last SYNC_COMMIT_MARGIN.
+
+    Sync cursors trail their read by that margin, so the next read returns
+    those rows again; unchanged ones are left out of the next event.
+    """
+
+    def __init__(self):
+        self.sent = {}
+
+    def drop_repeats(self, event):
+        now = time.monotonic()
+        horizon = now - SYNC_COMMIT_MARGIN.total_seconds()
+        self.sent = {key: value for key, value in self.sent.items() if value[1] >= horizon}
+
+        def fresh(key, stamp):
+            if key in self.sent and self.sent[key][0] == stamp:
+                return False
+            self.sent[key] = (stamp, now)
+            return True
+
+        event['notes'] = [row for row in event['notes'] if fresh(('note', row['id']), row['updated_at'])]
+        event['deleted'] = [note_id for note_id in event['deleted'] if fresh(('deleted', note_id), None)]
+        event['archived'] = [note_id for note_id in event['archived'] if fresh(('archived', note_id), None)]
+        return event
+
+
+class NoteEvents(AsyncAPIView):
+    """Server-Sent Events stream of the user's note and category changes.
+
+    Each ``changes`` event carries the notes changed, deleted and archived
+    since the previous one, shaped like a /api/notes/sync/ response, and the categories
+    when they differ from the last ones sent. Event ids are sync cursors, so a
+    client reconnecting with ``Last-Event-ID`` (or ``?last_event_id=``) gets
+    exactly what it missed. Streams hold their connection open, so they are
+    only served with SERVER_MODE=asgi. The database connection is only held
+    while an event is read, so open streams do not count against the
+    database's connection limit.
+    """
+    authentication_required = True
+
+    async def get(self, request, *args, **kwargs):
+        if not isinstance(request, ASGIRequest):
+            return json_response({"error": "The event stream needs SERVER_MODE=asgi"}, status.HTTP_501_NOT_IMPLEMENTED)
+        since = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+        if since:
+            try:
+                since = parse_sync_cursor(since)
+            except ValueError:
+                raise ValidationError({"last_event_id": ["Must be the id of an event from this stream."]})
+
+        response = StreamingHttpResponse(self.stream(request.user.id, since or None), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx would otherwise hold events back
+        return response
+
+    async def stream(self, user_id, since):
+        # Subscribe before the first read so a write landing in between still wakes the stream
+        subscription = get_event_broker().subscribe(user_id)
+        categories = None
+        sent = SentChanges()
+        try:
+            yield f'retry: {settings.EVENT_STREAM_RETRY_MS}\n\n'
+            changed = True
+            while True:
+                if changed:
+                    event, categories = await sync_to_async(self.changes)(user_id, since, categories)
+                    since = parse_sync_cursor(event['cursor'])
+                    event = sent.drop_repeats(event)
+                    # The first event always has the categories, so the client learns a cursor to resume from
+                    if event['notes'] or event['deleted'] or event['archived'] or event['reset'] or 'categories' in event:
+                        yield self.format_event('changes', event['cursor'], event)
+                else:
+                    yield ': keepalive\n\n'
+                changed = await subscription.wait(settings.EVENT_STREAM_KEEPALIVE)
+        finally:
+            subscription.close()
+
+    def changes(self, user_id, since, sent_categories):
+        try:
+            event = note_changes(user_id, since)
+            categories = CategorySerializer(Category.objects.active().filter(user_id=user_id).order_by('id'), many=True).data
+        finally:
+            # Each request's thread-sensitive calls share one thread, and its connection would otherwise stay open
+            # until request_finished, when the stream ends. An idle stream holds no database connection
+            if not connection.in_atomic_block:
+                connection.close()
+        if categories != sent_categories:
+            event['categories'] = categories
+        return event, categories
+
+    def format_event(self, name, event_id, data):
+        return f'id: {event_id}\nevent: {name}\ndata: {JSONRenderer().render(data).decode()}\n\n'
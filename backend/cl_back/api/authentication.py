@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .models import Profile
+
+# Everything views read from request.user and its profile. The password hash is left out of the cache: it is
+# deferred on cached users and read from the database only when something asks for it
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields if field.name != 'password']
+PROFILE_FIELDS = [field.attname for field in Profile._meta.concrete_fields]
+
+
+def user_cache_key(user_id):
+    return f'auth-user:{user_id}'
+
+
+def cached_values(user):
+    try:
+        profile = [getattr(user.profile, name) for name in PROFILE_FIELDS]
+    except Profile.DoesNotExist:
+        profile = None
+    return {'user': [getattr(user, name) for name in USER_FIELDS], 'profile': profile}
+
+
+def cached_user(values, using='default'):
+    user = User.from_db(using, USER_FIELDS, values['user'])
+    if values['profile'] is not None:
+        user.profile = Profile.from_db(using, PROFILE_FIELDS, values['profile'])
+    else:
+        # Known to have none, as after select_related, so reading it raises without a query
+        User.profile.related.set_cached_value(user, None)
+    return user
+
+
+def load_user(user_id):
+    """The user with this token id, profile attached, from AUTH_USER_CACHE or the database."""
+    cache = caches[settings.AUTH_USER_CACHE]
+    values = cache.get(user_cache_key(user_id))
+    if values is None:
+        user = User.objects.select_related('profile').filter(**{jwt_settings.USER_ID_FIELD: user_id}).first()
+        if user is None:
+            return None
+        values = cached_values(user)
+        cache.set(user_cache_key(user_id), values, settings.AUTH_USER_CACHE_TTL)
+    return cached_user(values)
+
+
+def forget_user(user_id):
+    """Drop a cached user once the current transaction has committed."""
+    transaction.on_commit(lambda: caches[settings.AUTH_USER_CACHE].delete(user_cache_key(user_id)))
+
+
+def forget_saved_user(sender, instance, **kwargs):
+    """post_save/post_delete handler for User and Profile.
+
+    Covers password changes, profile updates and deactivation. Writes that
+    bypass signals, such as queryset updates, call ``forget_user`` themselves
+    or are picked up when AUTH_USER_CACHE_TTL runs out.
+    """
+    forget_user(instance.user_id if sender is not User else getattr(instance, jwt_settings.USER_ID_FIELD))
+
+
+class CachedUserManager:
+    def get(self, **lookup):
+        user = load_user(lookup[jwt_settings.USER_ID_FIELD])
+        if user is None:
+            raise User.DoesNotExist
+        return user
+
+
+class CachedUserModel:
+    """Stands in for the user model in JWTAuthentication, so only its user lookup changes."""
+    objects = CachedUserManager()
+    DoesNotExist = User.DoesNotExist
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication resolving the token's user, with its profile, through the cache.
+
+    A warm request skips the user query, and the profile query of views
+    that read ``request.user.profile``. simplejwt's own checks still run on
+    the cached user; CHECK_REVOKE_TOKEN reads the deferred password hash, so
+    with it on every request queries the user's password.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_model = CachedUserModel
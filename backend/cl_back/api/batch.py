@@ -0,0 +1,139 @@
+from itertools import chain
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .models import Category, Note, NoteTombstone
+
+
+class NoteBatch:
+    """Applies an ordered list of note operations for one user in a single transaction.
+
+    Every real note and category id referenced by the batch is checked against
+    the user in one query each, up front, with their trees locked. Notes
+    created by the batch can be referenced by later operations through their
+    ``temp_id``. Tree maintenance goes through the regular model save/delete and
+    ``Note.objects.move_subtree`` so MPTT fields stay consistent.
+    """
+    FIELDS = ('content', 'order', 'scratched_out', 'important')
+
+    def __init__(self, user, operations):
+        self.user = user
+        self.operations = operations
+        self.temp_ids = {}
+        self.touched = set()
+        self.deleted = set()
+
+    def apply(self):
+        with transaction.atomic():
+            self.load()
+            for index, operation in enumerate(self.operations):
+                try:
+                    getattr(self, operation['op'])(operation)
+                except ValidationError as exc:
+                    raise ValidationError({'operations': {index: exc.detail}})
+        return Note.objects.filter(id__in=self.touched - self.deleted).order_by('root_order', 'tree_id', 'lft')
+
+    def load(self):
+        note_ids = {
+            operation[key]
+            for operation in self.operations
+            for key in ('id', 'parent')
+            if isinstance(operation.get(key), int)
+        }
+        self.notes = Note.objects.lock_trees(self.user, note_ids)
+        # Parents' categories too: notes of a deleted category wait for the purge but take no new children
+        category_ids = {operation['category'] for operation in self.operations if 'category' in operation}
+        category_ids |= {note.category_id for note in self.notes.values()}
+        self.categories = {category.id: category for category in Category.objects.active().filter(id__in=category_ids, user=self.user)}
+
+    def note(self, reference):
+        if isinstance(reference, str):
+            if reference not in self.temp_ids:
+                raise ValidationError({'id': [f'Unknown temporary id "{reference}".']})
+            note = self.temp_ids[reference]
+        else:
+            note = self.notes.get(reference)
+        # Deleted instances lose their pk; descendants removed by the cascade are listed in self.deleted
+        if note is None or note.pk is None or note.pk in self.deleted:
+            raise ValidationError({'id': [f'Note {reference} does not exist.']})
+        return note
+
+    def category(self, category_id):
+        if category_id not in self.categories:
+            raise ValidationError({'category': [f'Category {category_id} does not exist.']})
+        return self.categories[category_id]
+
+    def parent(self, operation):
+        if operation.get('parent') is None:
+            return None
+        try:
+            return self.note(operation['parent'])
+        except ValidationError:
+            raise ValidationError({'parent': [f"Note {operation['parent']} does not exist."]})
+
+    def create(self, operation):
+        parent = self.parent(operation)
+        category = self.category(operation['category'] if 'category' in operation else parent.category_id)
+        if parent is not None:
+            parent._mptt_refresh()
+            if parent.category_id != category.id:
+                raise ValidationError({'category': ['A child note must be in its parent\'s category.']})
+
+        if operation.get('temp_id') in self.temp_ids:
+            raise ValidationError({'temp_id': [f'Temporary id "{operation["temp_id"]}" is already used in this batch.']})
+
+        note = Note(author=self.user, category=category, parent=parent)
+        for field in self.FIELDS:
+            if field in operation:
+                setattr(note, field, operation[field])
+        note.save()
+        if 'temp_id' in operation:
+            self.temp_ids[operation['temp_id']] = note
+        self.touched.add(note.id)
+
+    def update(self, operation):
+        note = self.note(operation['id'])
+        for field in self.FIELDS:
+            if field in operation:
+                setattr(note, field, operation[field])
+        note._mptt_refresh()
+        note.save()
+        self.touched.add(note.id)
+
+    def move(self, operation):
+        note = self.note(operation['id'])
+        parent = self.parent(operation)
+        note._mptt_refresh()
+        category_id = None
+        if parent is not None:
+            parent._mptt_refresh()
+            if parent.pk == note.pk or parent.is_descendant_of(note):
+                raise ValidationError({'parent': ['A note cannot be moved under itself.']})
+            self.category(parent.category_id)
+        elif 'category' in operation:
+            category_id = self.category(operation['category']).id
+
+        # Appended after the new siblings; a root gets an order key among its new category's roots
+        Note.objects.move_subtree(note, parent, category_id=category_id)
+        self.refresh()
+        self.touched.add(note.id)
+
+    def refresh(self):
+        """Reload the notes held by the batch after a move.
+
+        A move rewrites the category and ``root_order`` of a whole subtree, and
+        may respace other roots, in the database only.
+        """
+        cached = {note.pk: note for note in chain(self.notes.values(), self.temp_ids.values()) if note.pk is not None}
+        fields = ('category_id', 'order', 'root_order', 'updated_at', 'archived_at', 'parent_id', 'tree_id', 'lft', 'rght', 'level')
+        for values in Note.objects.filter(pk__in=cached).values('pk', *fields):
+            note = cached[values.pop('pk')]
+            for field, value in values.items():
+                setattr(note, field, value)
+
+    def delete(self, operation):
+        note = self.note(operation['id'])
+        note._mptt_refresh()
+        self.deleted.update(NoteTombstone.record(note.get_descendants(include_self=True)))
+        note.delete()
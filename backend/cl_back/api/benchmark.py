@@ -0,0 +1,127 @@
+import statistics
+import time
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Note
+from .transfer import ChecklistImporter
+
+# Queries one warm request may run, savepoints included; the JWT user comes from the auth cache.
+# Checked by the tests and reported by the bench_api command; none of them grow with the number of notes.
+QUERY_BUDGETS = {
+    'notes_list': 2,
+    'notes_list_page': 2,
+    'notes_create': 5,
+    'notes_reorder': 6,
+    'notes_reset_order': 4,
+    'presence_heartbeat': 0,
+    'presence_stats': 0,
+}
+
+
+def seed_records(categories, roots, depth, width):
+    """Export-format records for ``categories`` checklists of ``roots`` trees each.
+
+    Every tree is ``depth`` levels deep and every non-leaf note has ``width`` children.
+    """
+    next_id = 0
+
+    def tree(category_id, parent_id, level, label):
+        nonlocal next_id
+        next_id += 1
+        note_id = next_id
+        yield {'type': 'note', 'id': note_id, 'category': category_id, 'parent': parent_id, 'content': f'Item {label}'}
+        if level + 1 < depth:
+            for child in range(width):
+                yield from tree(category_id, note_id, level + 1, f'{label}.{child + 1}')
+
+    for category_id in range(1, categories + 1):
+        yield {'type': 'category', 'id': category_id, 'title': f'Checklist {category_id}'}
+    for category_id in range(1, categories + 1):
+        for root in range(roots):
+            yield from tree(category_id, None, 0, f'{category_id}-{root + 1}')
+
+
+def seed_users(users, categories, roots, depth, width, prefix='seed', password='password'):
+    """Create ``users`` accounts filled with ``seed_records`` through the bulk importer."""
+    password_hash = make_password(password)
+    created = []
+    for _ in range(users):
+        user = User.objects.create(username=f'{prefix}-{uuid.uuid4().hex[:12]}', password=password_hash)
+        ChecklistImporter(user).run(seed_records(categories, roots, depth, width))
+        created.append(user)
+    return created
+
+
+def api_client(user):
+    client = APIClient(HTTP_HOST='localhost')
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+    return client
+
+
+def endpoints(user):
+    """The hot paths as ``name -> prepare(client)``; ``prepare`` returns a call that makes one request."""
+    category = user.categories.order_by('id').first()
+
+    def reorder(client):
+        # Move the last root of the first checklist to the top, a different note every time
+        roots = list(
+            Note.objects.filter(author=user, category=category, parent__isnull=True)
+            .order_by('order').values_list('id', flat=True)
+        )
+        return lambda: client.post('/api/notes/order/', {'ordering': roots[-1:] + roots[:-1]}, format='json')
+
+    return {
+        'notes_list': lambda client: lambda: client.get('/api/notes/'),
+        'notes_list_page': lambda client: lambda: client.get('/api/notes/', {'limit': 200}),
+        'notes_create': lambda client: lambda: client.post(
+            '/api/notes/', {'content': 'Benchmark note', 'category': category.id}, format='json',
+        ),
+        'notes_reorder': reorder,
+        'notes_reset_order': lambda client: lambda: client.post(
+            '/api/notes/reset-order/', {'category_id': category.id}, format='json',
+        ),
+        'presence_heartbeat': lambda client: lambda: client.post(
+            '/api/presence/heartbeat/', {'visitor_id': uuid.uuid4().hex}, format='json',
+        ),
+        'presence_stats': lambda client: lambda: client.get('/api/presence/stats/'),
+    }
+
+
+def measure(client, prepare):
+    """Make one request and return ``(milliseconds, queries)``; fails on an error response."""
+    send = prepare(client)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        response = send()
+        elapsed = (time.perf_counter() - start) * 1000
+    if response.status_code >= 400:
+        raise AssertionError(f'{response.status_code}: {getattr(response, "data", response.content)}')
+    return elapsed, len(queries)
+
+
+def run_benchmarks(user, repeat):
+    client = api_client(user)
+    results = {}
+    for name, prepare in endpoints(user).items():
+        measure(client, prepare)  # Warm caches and connections
+        timings, query_counts = [], []
+        for _ in range(repeat):
+            elapsed, queries = measure(client, prepare)
+            timings.append(elapsed)
+            query_counts.append(queries)
+        timings.sort()
+        results[name] = {
+            'median_ms': round(statistics.median(timings), 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+            'min_ms': round(timings[0], 3),
+            'queries': max(query_counts),
+            'query_budget': QUERY_BUDGETS[name],
+        }
+    return results
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .workers import process_singleton
+
+
+class Subscription:
+    """One event stream's interest in a user's changes.
+
+    Notifications only say that something changed, so several arriving
+    before the stream wakes up are coalesced into one.
+    """
+
+    def __init__(self, broker, user_id, loop):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = loop
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        """Wake the stream; safe to call from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self.changed.set)
+        except RuntimeError:
+            pass  # The stream's loop is already closed
+
+    async def wait(self, timeout):
+        """Wait up to ``timeout`` seconds for a change; returns whether one arrived."""
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.changed.clear()
+        return True
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class EventBroker(ABC):
+    """Carries per-user change notifications from write paths to event streams.
+
+    ``publish`` is called from request threads after a write commits;
+    ``subscribe`` and ``unsubscribe`` from an event stream running on the
+    event loop. A broker reaching other processes, such as one on a
+    Redis-compatible server's pub/sub with a channel per user, implements all
+    three and calls ``notify()`` on its local subscriptions for every message
+    received.
+    """
+
+    @abstractmethod
+    def publish(self, user_id):
+        ...
+
+    @abstractmethod
+    def subscribe(self, user_id):
+        ...
+
+    @abstractmethod
+    def unsubscribe(self, subscription):
+        ...
+
+
+class LocalBroker(EventBroker):
+    """Fans notifications out to the streams of this process only.
+
+    Enough for the single worker the deployment runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def publish(self, user_id):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.user_id]
+
+
+@process_singleton
+def get_event_broker():
+    return import_string(settings.EVENT_BROKER)()
+
+
+def publish_change(user_id):
+    """Tell the user's event streams about a write once the current transaction has committed."""
+    transaction.on_commit(lambda: get_event_broker().publish(user_id))
@@ -0,0 +1,217 @@
+import posixpath
+import uuid
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from PIL import ExifTags, Image, ImageOps
+
+from .authentication import forget_user
+from .models import Profile, UserVersion
+from .workers import BackgroundWorkers, process_singleton
+
+PUBLIC_DIR = 'profile_pictures'
+VARIANT_DIR = 'profile_pictures/variants'
+# Uploads wait here, under Profile.profile_picture's upload_to, until process_profile_picture has stripped them
+PENDING_DIR = 'profile_pictures/pending'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_DROPPED_CHUNKS = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+# APPn segments a JPEG keeps: JFIF and JFXX headers, the ICC colour profile and Adobe's colour transform
+JPEG_KEPT_APP_SEGMENTS = (b'JFIF\x00', b'JFXX\x00', b'ICC_PROFILE\x00', b'Adobe')
+
+
+def pending_name(upload):
+    """The name an upload is stored under, in PENDING_DIR, until a worker has stripped its metadata.
+
+    The name is random, so the unprocessed original cannot be found from its
+    upload name, and ProfileSerializer does not show its URL.
+    """
+    return f'{posixpath.basename(PENDING_DIR)}/{uuid.uuid4().hex}{posixpath.splitext(upload.name)[1].lower()}'
+
+
+def is_pending(picture):
+    return bool(picture) and picture.name.startswith(f'{PENDING_DIR}/')
+
+
+def strip_metadata(data):
+    """Return the image ``data`` without its EXIF (GPS included), XMP, IPTC or text metadata.
+
+    JPEG, PNG and WebP are rewritten at the container level, so the image
+    data, every animation frame and the colour profile are kept byte for
+    byte, and a JPEG keeps its EXIF orientation. Other formats are re-encoded
+    with all their frames.
+    """
+    if data.startswith(b'\xff\xd8'):
+        return strip_jpeg(data)
+    if data.startswith(PNG_SIGNATURE):
+        return strip_png(data)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return strip_webp(data)
+    return reencode(data)
+
+
+def strip_jpeg(data):
+    with Image.open(BytesIO(data)) as image:
+        orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    kept = []
+    pos = 2
+    while pos < len(data) - 1:
+        marker = data[pos + 1]
+        if data[pos] != 0xFF:
+            raise ValueError("Malformed JPEG")
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+        elif marker == 0xD9:  # End of image; whatever follows, such as MPF previews with their own EXIF, is dropped
+            break
+        elif 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            kept.append(data[pos:pos + 2])
+            pos += 2
+        else:
+            end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+            if marker == 0xDA:
+                # Entropy-coded scan data runs to the next marker other than a stuffed 0xFF00 or a restart marker
+                while True:
+                    end = data.index(b'\xff', end)
+                    if data[end + 1] != 0x00 and not 0xD0 <= data[end + 1] <= 0xD7:
+                        break
+                    end += 2
+            segment = data[pos:end]
+            metadata = 0xE0 <= marker <= 0xEF or marker == 0xFE
+            if not metadata or marker != 0xFE and segment[4:].startswith(JPEG_KEPT_APP_SEGMENTS):
+                kept.append(segment)
+            pos = end
+    if orientation != 1:
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = orientation
+        payload = exif.tobytes()
+        # APP1 comes after a JFIF APP0, which must be the first segment
+        at = 1 if kept and kept[0].startswith(b'\xff\xe0') else 0
+        kept.insert(at, b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload)
+    return b'\xff\xd8' + b''.join(kept) + b'\xff\xd9'
+
+
+def strip_png(data):
+    kept = [PNG_SIGNATURE]
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        end = pos + 12 + int.from_bytes(data[pos:pos + 4], 'big')
+        chunk_type = data[pos + 4:pos + 8]
+        if chunk_type not in PNG_DROPPED_CHUNKS:
+            kept.append(data[pos:end])
+        pos = end
+        if chunk_type == b'IEND':
+            break
+    return b''.join(kept)
+
+
+def strip_webp(data):
+    kept = [b'WEBP']
+    pos = 12
+    while pos + 8 <= len(data):
+        size = int.from_bytes(data[pos + 4:pos + 8], 'little')
+        end = pos + 8 + size + (size & 1)
+        chunk = data[pos:end]
+        if chunk[:4] == b'VP8X':
+            # Clear the EXIF and XMP flags of the extended header
+            chunk = chunk[:8] + bytes([chunk[8] & ~0x0C]) + chunk[9:]
+        if chunk[:4] not in (b'EXIF', b'XMP '):
+            kept.append(chunk)
+        pos = end
+    body = b''.join(kept)
+    return b'RIFF' + len(body).to_bytes(4, 'little') + body
+
+
+def reencode(data):
+    with Image.open(BytesIO(data)) as image:
+        image_format = image.format
+        options = {'comment': b''}
+        if image.info.get('icc_profile'):
+            options['icc_profile'] = image.info['icc_profile']
+        if getattr(image, 'n_frames', 1) > 1 and image_format in Image.SAVE_ALL:
+            options['save_all'] = True
+        else:
+            image = ImageOps.exif_transpose(image)
+        for key in ('exif', 'xmp', 'comment'):
+            image.info.pop(key, None)
+        buffer = BytesIO()
+        image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def render_variants(source, sizes, image_format, quality):
+    """Decode ``source`` once and return ``{size: bytes}`` of square, centre-cropped variants.
+
+    The image is turned upright from its EXIF orientation first; the variants
+    are written without any metadata.
+    """
+    with Image.open(source) as image:
+        image.draft('RGB', (max(sizes) * 2, max(sizes) * 2))  # Let JPEG decode at a reduced scale
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        variants = {}
+        for size in sizes:
+            buffer = BytesIO()
+            ImageOps.fit(image, (size, size), Image.LANCZOS).save(buffer, image_format, quality=quality, method=4)
+            variants[size] = buffer.getvalue()
+    return variants
+
+
+def process_profile_picture(profile_id):
+    """Write the variants of a profile's current picture and record them on the profile.
+
+    A picture still in PENDING_DIR is stored again, without its metadata, in
+    the public directory first, and the pending upload is deleted. Variants of
+    the previous picture are deleted. If the picture changed while this ran,
+    the newer upload's own job wins and these files are dropped.
+    """
+    profile = Profile.objects.filter(pk=profile_id).first()
+    if profile is None:
+        return
+    picture = profile.profile_picture
+    storage = Profile._meta.get_field('profile_picture').storage
+    old_paths = set(profile.picture_variants.values())
+    name = picture.name if picture else None
+    written = []
+    variants = {}
+    if picture:
+        with picture.open('rb') as source:
+            data = source.read()
+        if is_pending(picture):
+            name = storage.save(f'{PUBLIC_DIR}/{picture.name.rsplit("/", 1)[-1]}', ContentFile(strip_metadata(data)))
+            written.append(name)
+        extension = settings.PROFILE_PICTURE_FORMAT.lower()
+        rendered = render_variants(
+            BytesIO(data), settings.PROFILE_PICTURE_SIZES, settings.PROFILE_PICTURE_FORMAT, settings.PROFILE_PICTURE_QUALITY,
+        )
+        stem = name.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        for size, content in rendered.items():
+            variants[str(size)] = storage.save(f'{VARIANT_DIR}/{profile.user_id}/{stem}-{size}.{extension}', ContentFile(content))
+        written += variants.values()
+
+    unchanged = Q(profile_picture=picture.name) if picture else Q(profile_picture__isnull=True) | Q(profile_picture='')
+    updated = Profile.objects.filter(unchanged, pk=profile_id).update(profile_picture=name, picture_variants=variants)
+    if updated:
+        # The user detail ETag must change so clients pick the picture and its variants up
+        UserVersion.bump(profile.user_id)
+        forget_user(profile.user_id)
+        if name != picture.name:
+            old_paths.add(picture.name)
+    for path in (old_paths if updated else written):
+        storage.delete(path)
+
+
+@process_singleton
+def get_picture_workers():
+    return BackgroundWorkers(
+        process_profile_picture, settings.PROFILE_PICTURE_WORKERS, 'picture',
+        "Processing the picture of profile %s failed",
+    )
+
+
+def schedule_picture_processing(profile):
+    """Queue variant generation once the current transaction has committed."""
+    profile_id = profile.pk
+    transaction.on_commit(lambda: get_picture_workers().submit(profile_id))
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import Note, UserVersion
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive subtrees whose notes are all scratched out and have not changed for a while, "
+        "taking them out of the notes list. Run it periodically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.NOTE_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--user', type=int, help="Only archive this user's notes.")
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        # Only authors with a completed note old enough can have anything to archive
+        authors = Note.objects.filter(archived_at__isnull=True, scratched_out=True, updated_at__lt=before)
+        if options['user'] is not None:
+            authors = authors.filter(author_id=options['user'])
+        archived = 0
+        for author_id in authors.order_by('author_id').values_list('author_id', flat=True).distinct():
+            count = Note.objects.archive_completed(author_id, before)
+            if count:
+                UserVersion.bump(author_id)
+                archived += count
+        self.stdout.write(f"Archived {archived} note(s).")
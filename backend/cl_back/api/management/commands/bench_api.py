@@ -0,0 +1,62 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.benchmark import run_benchmarks, seed_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the API hot paths and count their queries against the configured database, printing JSON. "
+        "Runs inside a transaction that is rolled back, so a seeded account is thrown away afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="Benchmark this existing account instead of seeding one.")
+        parser.add_argument('--categories', type=int, default=5)
+        parser.add_argument('--roots', type=int, default=50)
+        parser.add_argument('--depth', type=int, default=3)
+        parser.add_argument('--width', type=int, default=4)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--output', '-o', help="Also write the results to this file.")
+        parser.add_argument('--compare', help="Results file of an earlier run to compare against.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['user']:
+                try:
+                    user = User.objects.get(username=options['user'])
+                except User.DoesNotExist:
+                    raise CommandError(f"User {options['user']!r} does not exist.")
+            else:
+                [user] = seed_users(1, options['categories'], options['roots'], options['depth'], options['width'], prefix='bench')
+            report = {
+                'database': connection.vendor,
+                'notes': user.notes.count(),
+                'repeat': options['repeat'],
+                'endpoints': run_benchmarks(user, options['repeat']),
+            }
+            transaction.set_rollback(True)
+
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as results:
+                results.write(output + '\n')
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as baseline:
+                self.compare(json.load(baseline), report)
+
+    def compare(self, baseline, report):
+        self.stderr.write(f"{'endpoint':<20}{'median ms':>22}{'queries':>12}")
+        for name, result in report['endpoints'].items():
+            before = baseline.get('endpoints', {}).get(name)
+            if before is None:
+                continue
+            change = (result['median_ms'] / before['median_ms'] - 1) * 100 if before['median_ms'] else 0
+            self.stderr.write(
+                f"{name:<20}{before['median_ms']:>9.2f} -> {result['median_ms']:>7.2f} ({change:+.0f}%)"
+                f"{before['queries']:>6} -> {result['queries']}"
+            )
@@ -0,0 +1,62 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Category, Note
+from api.serializers import NoteSerializer, nest_notes
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the ModelSerializer and values() read paths of the notes list on a throwaway account. "
+        "Everything is created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--notes', type=int, default=10000)
+        parser.add_argument('--children', type=int, default=9, help="Children per root note.")
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = self.seed(options['notes'], options['children'])
+            queryset = Note.objects.filter(author=user).order_by('root_order', 'tree_id', 'lft')
+            paths = {
+                'serializer': lambda: NoteSerializer(queryset.all(), many=True).data,
+                'values': lambda: NoteSerializer.serialize_values(queryset.all()),
+                'values+tree': lambda: nest_notes(NoteSerializer.serialize_values(queryset.all())),
+            }
+            for name, path in paths.items():
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    path()
+                    timings.append((time.perf_counter() - start) * 1000)
+                self.stdout.write(f"{name:>12}: median {statistics.median(timings):8.1f} ms, best {min(timings):8.1f} ms")
+            transaction.set_rollback(True)
+
+    def seed(self, total, children):
+        user = User.objects.create(username=f"bench-{time.time_ns()}")
+        category = Category.objects.create(title="Benchmark", user=user)
+        first_tree_id = Note.objects.next_tree_id(user.id)
+        tree_size = children + 1
+        roots = Note.objects.bulk_create([
+            Note(
+                content=f"Root {i}", author=user, category=category, order=i + 1, root_order=i + 1,
+                tree_id=first_tree_id + i, lft=1, rght=2 * tree_size, level=0,
+            )
+            for i in range(max(1, total // tree_size))
+        ])
+        Note.objects.bulk_create([
+            Note(
+                content=f"Item {j} of {root.content}", author=user, category=category, parent=root,
+                root_order=root.order, tree_id=root.tree_id, lft=2 * j, rght=2 * j + 1, level=1,
+            )
+            for root in roots
+            for j in range(1, tree_size)
+        ], batch_size=1000)
+        self.stdout.write(f"Seeded {Note.objects.filter(author=user).count()} notes.")
+        return user
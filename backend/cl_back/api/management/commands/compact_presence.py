@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.presence import compact_presence
+
+
+class Command(BaseCommand):
+    help = "Roll stale VisitorPresence rows into daily aggregates and delete them in bounded batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.PRESENCE_RETENTION_DAYS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        purged = compact_presence(options['retention_days'], options['batch_size'])
+        self.stdout.write(f"Compacted {purged} visitor row(s).")
@@ -0,0 +1,27 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api.transfer import export_records, json_chunks, ndjson_lines
+
+
+class Command(BaseCommand):
+    help = "Write a user's categories and notes as NDJSON (or one JSON array), streamed from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--output', '-o', help="File to write; standard output when omitted.")
+        parser.add_argument('--json', action='store_true', help="Write one JSON array instead of NDJSON.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['username']!r} does not exist.")
+        records = export_records(user)
+        chunks = json_chunks(records) if options['json'] else ndjson_lines(records)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
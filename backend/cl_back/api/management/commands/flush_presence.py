@@ -0,0 +1,19 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from api.presence import CachePresenceStore, build_presence_store
+
+
+class Command(BaseCommand):
+    help = "Write heartbeats buffered by the presence store to VisitorPresence."
+
+    def handle(self, *args, **options):
+        # Not get_presence_store(), which would start a flusher thread in this process too
+        store = build_presence_store()
+        if isinstance(store, CachePresenceStore) and isinstance(store.cache, LocMemCache):
+            raise CommandError(
+                "PRESENCE_CACHE is local to each process, so this command can only see its own empty buffer. "
+                "Point it at a shared cache (PRESENCE_CACHE_BACKEND) to flush from outside the app."
+            )
+        written = store.flush()
+        self.stdout.write(f"Flushed {written} visitor(s).")
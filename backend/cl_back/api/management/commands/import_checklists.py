@@ -0,0 +1,30 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from api.models import UserVersion
+from api.transfer import ChecklistImporter, parse_ndjson
+
+
+class Command(BaseCommand):
+    help = "Add the categories and notes of an NDJSON or JSON export to a user's account."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path', help="NDJSON file, or a JSON array when it ends in .json.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['username']!r} does not exist.")
+        with open(options['path'], encoding='utf-8') as source:
+            records = json.load(source) if options['path'].endswith('.json') else parse_ndjson(source)
+            try:
+                result = ChecklistImporter(user).run(records)
+            except ValidationError as exc:
+                raise CommandError(exc.detail)
+        UserVersion.bump(user.id)
+        self.stdout.write(f"Imported {result['categories']} categor(ies) and {result['notes']} note(s).")
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+
+class Client:
+    """One polling browser tab: a keep-alive HTTP/1.1 connection sending a heartbeat and a stats poll every interval."""
+
+    def __init__(self, host, port, results):
+        self.host = host
+        self.port = port
+        self.results = results
+        self.visitor_id = uuid.uuid4().hex
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b''):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # Sent as if through the TLS-terminating nginx in front of the app
+        head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nUser-Agent: load-test\r\nX-Forwarded-Proto: https\r\n'
+        if body:
+            head += f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n'
+        self.writer.write(head.encode() + b'\r\n' + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def timed(self, method, path, body=b''):
+        start = time.perf_counter()
+        try:
+            status = await self.request(method, path, body)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            self.close()
+            self.results['errors'] += 1
+            return
+        self.results['latencies'].append(time.perf_counter() - start)
+        if status >= 400:
+            self.results['errors'] += 1
+
+    async def run(self, interval, deadline):
+        heartbeat = json.dumps({'visitor_id': self.visitor_id}).encode()
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            await self.timed('POST', '/api/presence/heartbeat/', heartbeat)
+            await self.timed('GET', '/api/presence/stats/')
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+        self.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate many browser tabs polling the presence endpoints of a running server and print JSON "
+        "with throughput and latency percentiles. Compare SERVER_MODE=wsgi and SERVER_MODE=asgi deployments."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--interval', type=float, default=5.0, help="Seconds between a client's polls.")
+        parser.add_argument('--duration', type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        results = {'latencies': [], 'errors': 0}
+        started = time.monotonic()
+        asyncio.run(self.run(url.hostname, url.port or 80, options, results))
+        elapsed = time.monotonic() - started
+
+        latencies = sorted(results['latencies'])
+
+        def percentile(share):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * share))] * 1000, 1) if latencies else None
+
+        self.stdout.write(json.dumps({
+            'url': options['url'],
+            'clients': options['clients'],
+            'interval_s': options['interval'],
+            'requests': len(latencies),
+            'errors': results['errors'],
+            'requests_per_s': round(len(latencies) / elapsed, 1),
+            'median_ms': round(statistics.median(latencies) * 1000, 1) if latencies else None,
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+        }, indent=2))
+
+    async def run(self, host, port, options, results):
+        deadline = time.monotonic() + options['duration']
+        clients = [Client(host, port, results) for _ in range(options['clients'])]
+        # Spread the first polls over one interval, like tabs opened at different times
+        spread = options['interval'] / max(1, len(clients))
+
+        async def start(index, client):
+            await asyncio.sleep(index * spread)
+            await client.run(options['interval'], deadline)
+
+        await asyncio.gather(*(start(index, client) for index, client in enumerate(clients)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from api.images import PENDING_DIR, process_profile_picture
+from api.models import Profile
+
+
+class Command(BaseCommand):
+    help = "Strip and resize profile pictures, by default only uploads not processed yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Regenerate the variants of every picture.")
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True)
+        if not options['all']:
+            profiles = profiles.filter(Q(picture_variants={}) | Q(profile_picture__startswith=f'{PENDING_DIR}/'))
+        processed = 0
+        for profile_id in profiles.values_list('pk', flat=True).iterator():
+            process_profile_picture(profile_id)
+            processed += 1
+        self.stdout.write(f"Processed {processed} picture(s).")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Category
+from api.purge import purge_category
+
+
+class Command(BaseCommand):
+    help = "Delete the notes of archived categories and then the categories, finishing purges cut short by a restart."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help="Notes per transaction; defaults to CATEGORY_PURGE_BATCH.")
+
+    def handle(self, *args, **options):
+        categories = notes = 0
+        for category_id in Category.objects.filter(archived_at__isnull=False).order_by('archived_at').values_list('pk', flat=True):
+            notes += purge_category(category_id, options['batch_size'])
+            categories += 1
+        self.stdout.write(f"Purged {categories} categor{'y' if categories == 1 else 'ies'} and {notes} note(s).")
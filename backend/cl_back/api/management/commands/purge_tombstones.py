@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from api.models import NoteTombstone
+
+
+class Command(BaseCommand):
+    help = "Delete note tombstones older than their retention window. Run it periodically."
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Deleted {NoteTombstone.purge_expired()} tombstone(s).")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Category, Note
+
+
+class Command(BaseCommand):
+    help = "Respace the sparse order keys of root notes, category by category, keeping their order."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help="Only rebalance this user's categories.")
+
+    def handle(self, *args, **options):
+        categories = Category.objects.active().order_by('id')
+        if options['user']:
+            categories = categories.filter(user_id=options['user'])
+        changed = 0
+        for category in categories.iterator():
+            changed += Note.objects.rebalance_roots(category.user_id, category.id)
+        self.stdout.write(f"Rewrote {changed} order key(s).")
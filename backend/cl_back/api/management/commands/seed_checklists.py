@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api.benchmark import seed_users
+
+
+class Command(BaseCommand):
+    help = "Create users filled with checklists of deep and wide note trees, for benchmarks and load tests."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1)
+        parser.add_argument('--categories', type=int, default=5, help="Checklists per user.")
+        parser.add_argument('--roots', type=int, default=50, help="Top-level notes per checklist.")
+        parser.add_argument('--depth', type=int, default=3, help="Levels per tree, the root included.")
+        parser.add_argument('--width', type=int, default=4, help="Children per non-leaf note.")
+        parser.add_argument('--prefix', default='seed', help="Username prefix.")
+        parser.add_argument('--password', default='password')
+
+    def handle(self, *args, **options):
+        users = seed_users(
+            options['users'], options['categories'], options['roots'], options['depth'], options['width'],
+            prefix=options['prefix'], password=options['password'],
+        )
+        for user in users:
+            self.stdout.write(f"{user.username}: {user.notes.count()} notes")
@@ -0,0 +1,108 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class QueryTimer:
+    """Database execute wrapper counting queries and the time spent in them."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+# The timer of the request being served. Context variables follow a request into
+# sync_to_async threads, so queries of async views are counted as well
+current_timer = ContextVar('current_timer', default=None)
+
+
+def time_queries(execute, sql, params, many, context):
+    timer = current_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created handler: route every connection's queries through ``time_queries``."""
+    if time_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_queries)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    """Per-view request histograms, kept in process memory.
+
+    Each worker process keeps its own; the deployment runs a single gunicorn
+    worker, so one scrape sees every request.
+    """
+    series = (
+        ('request_duration_seconds', 'Time to produce the response.', TIME_BUCKETS),
+        ('request_db_seconds', 'Time spent in database queries.', TIME_BUCKETS),
+        ('request_encode_seconds', 'Time the renderer spent encoding the response body.', TIME_BUCKETS),
+        ('request_queries', 'Database queries per request.', QUERY_BUCKETS),
+    )
+    prefix = 'cl_back_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def observe(self, view, duration, db, encode, queries):
+        with self.lock:
+            histograms = self.views.get(view)
+            if histograms is None:
+                histograms = self.views[view] = [Histogram(buckets) for _, _, buckets in self.series]
+            for histogram, value in zip(histograms, (duration, db, encode, queries)):
+                histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    def prometheus(self):
+        """The histograms in the Prometheus text exposition format."""
+        with self.lock:
+            views = sorted((view, [(h.counts[:], h.sum, h.count) for h in histograms]) for view, histograms in self.views.items())
+        lines = []
+        for index, (name, help_text, buckets) in enumerate(self.series):
+            metric = self.prefix + name
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} histogram')
+            for view, histograms in views:
+                counts, total, count = histograms[index]
+                label = 'view="%s"' % view.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}}} {total}')
+                lines.append(f'{metric}_count{{{label}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
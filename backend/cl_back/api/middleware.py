@@ -0,0 +1,105 @@
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import QueryTimer, current_timer, request_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class is not None else match.view_name or match._func_path
+
+
+class RequestMetricsMiddleware:
+    """Times each sampled request and counts its queries.
+
+    The results go to a ``Server-Timing`` header, to the per-view histograms
+    served by ``/api/metrics/``, and to the log when a request takes longer
+    than SLOW_REQUEST_MS. ``encode`` is the renderer turning DRF's response
+    data into bytes; serializers run inside the view and count as ``app``. A request that is not sampled only pays for one
+    random draw; with METRICS_SAMPLE_RATE at 0 the middleware is left out.
+    Works in both the WSGI and the ASGI stack.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.METRICS_SAMPLE_RATE
+        self.slow_ms = settings.SLOW_REQUEST_MS
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+        timer, token, start = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        return self.finish(request, response, timer, start)
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+        timer, token, start = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        return self.finish(request, response, timer, start)
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def start(self, request):
+        timer = QueryTimer()
+        request._metrics_encode = [0.0, 0.0]
+        return timer, current_timer.set(timer), time.perf_counter()
+
+    def finish(self, request, response, timer, start):
+        duration = time.perf_counter() - start
+        encode = request._metrics_encode[1]
+
+        view = view_name(request)
+        request_metrics.observe(view, duration, timer.seconds, encode, timer.queries)
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={timer.seconds * 1000:.1f};desc="{timer.queries} queries"',
+            f'encode;dur={encode * 1000:.1f}',
+            f'app;dur={(duration - timer.seconds - encode) * 1000:.1f}',
+            f'total;dur={duration * 1000:.1f}',
+        ])
+        if duration * 1000 >= self.slow_ms:
+            logger.warning(
+                "Slow request: %s %s view=%s status=%s total=%.1fms db=%.1fms queries=%d encode=%.1fms",
+                request.method, request.path, view, response.status_code,
+                duration * 1000, timer.seconds * 1000, timer.queries, encode * 1000,
+            )
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook; time it up to the post-render callback
+        timing = getattr(request, '_metrics_encode', None)
+        if timing is not None:
+            timing[0] = time.perf_counter()
+
+            def rendered(response):
+                timing[1] = time.perf_counter() - timing[0]
+
+            response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_userversion'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['author', 'category', 'tree_id', 'lft'], name='note_author_cat_tree_lft'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['tree_id', 'lft'], name='api_note_tree_id_lft_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copy_root_order(apps, schema_editor):
+    Note = apps.get_model('api', 'Note')
+    root_order = Note.objects.filter(tree_id=models.OuterRef('tree_id'), parent__isnull=True).values('order')[:1]
+    Note.objects.update(root_order=models.Subquery(root_order))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_note_author_cat_tree_lft'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='note',
+            name='note_author_cat_tree_lft',
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='root_order',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(copy_root_order, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['author', 'root_order', 'tree_id', 'lft'], name='note_author_root_order'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['author', 'category', 'root_order', 'tree_id', 'lft'], name='note_author_cat_root_order'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_note_root_order'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='visitorpresence',
+            name='last_seen',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_totals(apps, schema_editor):
+    VisitorPresence = apps.get_model('api', 'VisitorPresence')
+    PresenceTotals = apps.get_model('api', 'PresenceTotals')
+    PresenceUser = apps.get_model('api', 'PresenceUser')
+    user_ids = VisitorPresence.objects.exclude(user__isnull=True).values_list('user', flat=True).distinct()
+    PresenceUser.objects.bulk_create([PresenceUser(user_id=user_id) for user_id in user_ids])
+    PresenceTotals.objects.create(
+        pk=1,
+        unique_visitors=VisitorPresence.objects.count(),
+        unique_users=PresenceUser.objects.count(),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_visitorpresence_last_seen_default'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceTotals',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unique_visitors', models.PositiveBigIntegerField(default=0)),
+                ('unique_users', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PresenceUser',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='presence', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(seed_totals, migrations.RunPython.noop),
+    ]
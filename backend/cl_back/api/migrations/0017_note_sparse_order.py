@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+ORDER_GAP = 1024
+
+
+def spread_orders(apps, schema_editor):
+    Note = apps.get_model('api', 'Note')
+    Note.objects.filter(parent__isnull=True).update(order=models.F('order') * ORDER_GAP)
+    Note.objects.update(root_order=models.F('root_order') * ORDER_GAP)
+
+
+def compact_orders(apps, schema_editor):
+    Note = apps.get_model('api', 'Note')
+    Note.objects.filter(parent__isnull=True).update(order=models.F('order') / ORDER_GAP)
+    Note.objects.update(root_order=models.F('root_order') / ORDER_GAP)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_presencedaily'),
+    ]
+
+    operations = [
+        migrations.RunPython(spread_orders, compact_orders),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+TREE_ID_BLOCK = 2 ** 32
+
+
+def partition_tree_ids(apps, schema_editor):
+    Note = apps.get_model('api', 'Note')
+    Note.objects.update(tree_id=models.F('author_id') * TREE_ID_BLOCK + models.F('tree_id'))
+
+
+def merge_tree_ids(apps, schema_editor):
+    Note = apps.get_model('api', 'Note')
+    Note.objects.update(tree_id=models.F('tree_id') - models.F('author_id') * TREE_ID_BLOCK)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_note_sparse_order'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='note',
+            name='tree_id',
+            field=models.PositiveBigIntegerField(db_index=True, editable=False),
+        ),
+        migrations.RunPython(partition_tree_ids, merge_tree_ids),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# Postgres: a generated tsvector column, so every write (including queryset.update
+# and cascading deletes) keeps it current, with a GIN index for @@ lookups
+POSTGRES_FORWARD = [
+    "ALTER TABLE api_note ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED",
+    "CREATE INDEX note_search_vector ON api_note USING GIN (search_vector)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS note_search_vector",
+    "ALTER TABLE api_note DROP COLUMN IF EXISTS search_vector",
+]
+
+# SQLite: an external-content FTS5 table over api_note, kept current by triggers.
+# author_id is indexed as a token so a search only walks one user's postings
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE api_note_fts USING fts5("
+    "content, author_id, content='api_note', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER api_note_fts_insert AFTER INSERT ON api_note BEGIN "
+    "INSERT INTO api_note_fts(rowid, content, author_id) VALUES (new.id, new.content, new.author_id); END",
+    "CREATE TRIGGER api_note_fts_delete AFTER DELETE ON api_note BEGIN "
+    "INSERT INTO api_note_fts(api_note_fts, rowid, content, author_id) VALUES ('delete', old.id, old.content, old.author_id); END",
+    "CREATE TRIGGER api_note_fts_update AFTER UPDATE OF content, author_id ON api_note BEGIN "
+    "INSERT INTO api_note_fts(api_note_fts, rowid, content, author_id) VALUES ('delete', old.id, old.content, old.author_id); "
+    "INSERT INTO api_note_fts(rowid, content, author_id) VALUES (new.id, new.content, new.author_id); END",
+    "INSERT INTO api_note_fts(api_note_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS api_note_fts_insert",
+    "DROP TRIGGER IF EXISTS api_note_fts_delete",
+    "DROP TRIGGER IF EXISTS api_note_fts_update",
+    "DROP TABLE IF EXISTS api_note_fts",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_note_tree_id_per_author'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            run({'postgresql': POSTGRES_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_profile_picture_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_category_archived_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='note',
+            name='note_author_root_order',
+        ),
+        migrations.RemoveIndex(
+            model_name='note',
+            name='note_author_cat_root_order',
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('archived_at__isnull', True)), fields=['author', 'root_order', 'tree_id', 'lft'], name='note_author_root_order'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('archived_at__isnull', True)), fields=['author', 'category', 'root_order', 'tree_id', 'lft'], name='note_author_cat_root_order'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('archived_at__isnull', False)), fields=['author', 'root_order', 'tree_id', 'lft'], name='note_author_archived_order'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('archived_at__isnull', False)), fields=['author', 'archived_at'], name='note_author_archived_at'),
+        ),
+    ]
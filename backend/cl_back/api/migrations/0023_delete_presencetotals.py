@@ -0,0 +1,16 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:54
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_note_archived_at'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='PresenceTotals',
+        ),
+    ]
@@ -0,0 +1,44 @@
+import hashlib
+
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import permissions, status
+from rest_framework.response import Response
+
+from .models import UserVersion
+
+
+def version_etag(request, user_id, version):
+    """Strong ETag of a per-user GET response at the given data version."""
+    key = f"{user_id}:{version}:{request.get_full_path()}:{request.headers.get('Accept', '')}"
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+
+class VersionedWriteMixin:
+    """Bumps the requesting user's data version after every successful write."""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if (
+            request.method not in permissions.SAFE_METHODS
+            and status.is_success(response.status_code)
+            and request.user.is_authenticated
+        ):
+            UserVersion.bump(request.user.id)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class ConditionalGetMixin:
+    """Answers GET with a strong ETag derived from the user's data version.
+
+    A matching If-None-Match is answered with 304 before any queryset runs.
+    """
+
+    def get_etag(self, request, version):
+        return version_etag(request, request.user.id, version)
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request, UserVersion.current(request.user.id))
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response = super().get(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
@@ -1,43 +1,517 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
+from collections import defaultdict
+from datetime import timedelta
+from itertools import groupby
+from django.db.models import Case, When, Value, F, Q
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
+from .events import publish_change
+
+
+class CategoryQuerySet(models.QuerySet):
+    def active(self):
+        """Categories that are not archived and waiting for api.purge to delete them."""
+        return self.filter(archived_at__isnull=True)
 
 
 class Category(models.Model):
     title = models.CharField(max_length=100)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="categories")
+    # Set when the category is deleted; its notes are then purged in the background
+    archived_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = CategoryQuerySet.as_manager()
 
     def __str__(self):
         return self.title
 
+# Root notes are ordered by sparse keys, so a note can usually be placed between two
+# others by changing only its own key
+ORDER_GAP = 1024
+# Appending only ever grows the keys; past this (the largest PositiveIntegerField value on
+# every backend) the category is respaced
+ORDER_MAX = 2 ** 31 - 1
+
+
+def sparse_order_keys(current, gap=ORDER_GAP):
+    """Return order keys for a sequence whose current keys are ``current``.
+
+    The longest run of keys that is already increasing is kept as is and the
+    other items get keys spaced between their kept neighbours, so moving one
+    item rewrites one key. Returns ``None`` when there is no room left, below
+    the next key or ORDER_MAX, and the sequence needs rebalancing.
+    """
+    # Longest strictly increasing subsequence, O(n log n)
+    tails, tail_indices, previous = [], [], [None] * len(current)
+    for i, key in enumerate(current):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous[i] = tail_indices[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(key)
+            tail_indices.append(i)
+        else:
+            tails[lo] = key
+            tail_indices[lo] = i
+    kept = set()
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+
+    keys = list(current)
+    run = []
+    for i in range(len(current) + 1):
+        if i < len(current) and i not in kept:
+            run.append(i)
+            continue
+        if run:
+            low = keys[run[0] - 1] if run[0] > 0 else 0
+            if i < len(current):
+                step = (current[i] - low) // (len(run) + 1)
+            else:
+                step = min(gap, (ORDER_MAX - low) // len(run))
+            if step < 1:
+                return None
+            for offset, index in enumerate(run, start=1):
+                keys[index] = low + step * offset
+            run = []
+    return keys
+
+
+# Each author's trees are numbered inside their own block of tree ids, so the tree
+# maintenance django-mptt does for one user never renumbers another user's rows
+TREE_ID_BLOCK = 2 ** 32
+
+
+class NoteManager(TreeManager):
+    def tree_id_range(self, author_id):
+        start = author_id * TREE_ID_BLOCK
+        return start, start + TREE_ID_BLOCK
+
+    def next_tree_id(self, author_id):
+        start, end = self.tree_id_range(author_id)
+        last = self.filter(tree_id__gt=start, tree_id__lt=end).aggregate(models.Max('tree_id'))['tree_id__max']
+        return (last or start) + 1
+
+    def insert_node(self, node, target, position='last-child', save=False, allow_existing_pk=False, refresh_target=True):
+        if target is not None and not (target.is_root_node() and position in ('left', 'right')):
+            return super().insert_node(node, target, position, save, allow_existing_pk, refresh_target)
+        # A new root takes the next tree id in its author's block instead of the global maximum, or the
+        # one after its target root, which may be in another author's block
+        if node.pk and not allow_existing_pk and self.filter(pk=node.pk).exists():
+            raise ValueError("Cannot insert a node which has already been saved.")
+        node.lft, node.rght, node.level = 1, 2, 0
+        node.tree_id = self.next_tree_id(node.author_id)
+        node.parent = None
+        if save:
+            node.save()
+        return node
+
+    def _make_child_root_node(self, node, new_tree_id=None):
+        super()._make_child_root_node(node, new_tree_id or self.next_tree_id(node.author_id))
+
+    def _make_sibling_of_root_node(self, node, target, position):
+        # Roots are ordered by ``order``, not by tree id, so placing a note beside a root only makes it a tree of its
+        # own. django-mptt's default when a save sets parent to None targets the last root of any author
+        if node.is_child_node():
+            self._make_child_root_node(node)
+
+    def _create_tree_space(self, target_tree_id, num_trees=1):
+        # Only trees in the same author's block make room
+        block_end = (target_tree_id // TREE_ID_BLOCK + 1) * TREE_ID_BLOCK
+        queryset = self._mptt_filter(tree_id__gt=target_tree_id, tree_id__lt=block_end)
+        self._mptt_update(queryset, tree_id=F('tree_id') + num_trees)
+        self.tree_model._mptt_track_tree_insertions(target_tree_id + 1, num_trees)
+
+    def rebuild(self, batch_size=1000, **filters):
+        """Rebuild trees from ``parent`` links, numbering each author's trees in its own block.
+
+        Root trees are numbered by their order and siblings keep their current
+        order. A ``tree_id`` filter rebuilds just that tree, keeping its id.
+        """
+        if 'tree_id' in filters:
+            return super().rebuild(batch_size=batch_size, **filters)
+
+        self._find_out_rebuild_fields()
+        children = defaultdict(list)
+        for child in self._mptt_filter(parent__isnull=False, **filters).order_by('tree_id', 'lft').only('pk', 'parent'):
+            children[child.parent_id].append(child)
+
+        nodes_to_update = []
+        roots = self._mptt_filter(parent=None, **filters).order_by('author_id', 'order', 'tree_id').only('pk', 'author_id')
+        for author_id, author_roots in groupby(roots, key=lambda root: root.author_id):
+            start, _ = self.tree_id_range(author_id)
+            for offset, root in enumerate(author_roots, start=1):
+                self._rebuild_helper(
+                    node=root,
+                    left=1,
+                    tree_id=start + offset,
+                    children=children,
+                    nodes_to_update=nodes_to_update,
+                    level=0,
+                )
+        self.bulk_update(nodes_to_update, self._rebuild_fields.values(), batch_size=batch_size)
+
+    rebuild.alters_data = True
+
+    def in_active_categories(self):
+        """Notes whose category is not deleted.
+
+        A deleted category's notes stay until api.purge gets to them, but are
+        no longer served or written to.
+        """
+        return self.exclude(category_id__in=Category.objects.filter(archived_at__isnull=False).values('pk'))
+
+    def lock_trees(self, user, ids):
+        """Fetch the user's notes ``ids`` with every tree they belong to locked for update.
+
+        Notes of deleted categories are left out. The notes are read again once
+        their trees are locked, so their tree fields are current. Must run
+        inside a transaction.
+        """
+        locked = set()
+        while True:
+            notes = {note.id: note for note in self.in_active_categories().filter(id__in=ids, author=user)}
+            tree_ids = {note.tree_id for note in notes.values()}
+            if tree_ids <= locked:
+                return notes
+            list(self.select_for_update().filter(tree_id__in=tree_ids - locked).order_by('pk').values_list('pk', flat=True))
+            locked |= tree_ids
+
+    def move_subtree(self, note, parent, position=None, category_id=None):
+        """Move ``note`` and its descendants under ``parent``, or to the top level when it is ``None``.
+
+        ``position`` is the index among the new siblings, the end when omitted.
+        A top-level note gets a sparse order key between its new neighbours and
+        may change category; a child always takes its parent's category. The
+        subtree's category and ``root_order`` are then rewritten in one
+        statement. Both trees must be locked, see ``lock_trees``.
+        """
+        was_root = note.parent_id is None
+        same_category = category_id is None or category_id == note.category_id
+        if parent is not None:
+            category_id = parent.category_id
+            if parent.archived_at is not None:
+                self.restore_archived(parent)
+            # Positions count the notes the client sees, so archived ones are left out
+            siblings = list(parent.get_children().filter(archived_at__isnull=True).exclude(pk=note.pk))
+            if position is None or position >= len(siblings):
+                note.move_to(parent, 'last-child')
+            else:
+                note.move_to(siblings[position], 'left')
+            root_order = parent.root_order
+        else:
+            category_id = note.category_id if category_id is None else category_id
+            if not was_root:
+                # Becomes a tree of its own; unlike placing it left or right of a root, no tree ids shift
+                note.move_to(None)
+            roots = list(
+                self._for_ordering()
+                .filter(author_id=note.author_id, category_id=category_id, parent__isnull=True, archived_at__isnull=True)
+                .exclude(pk=note.pk)
+                .order_by('order', 'tree_id')
+            )
+            index = len(roots) if position is None else min(position, len(roots))
+            low = roots[index - 1].order if index else 0
+            high = roots[index].order if index < len(roots) else None
+            in_place = was_root and same_category and low < note.order and (high is None or note.order < high)
+            if not in_place:
+                if high is None and low + ORDER_GAP <= ORDER_MAX:
+                    note.order = low + ORDER_GAP
+                elif (high or ORDER_MAX + 1) - low > 1:
+                    note.order = (low + (high or ORDER_MAX + 1)) // 2
+                else:
+                    roots.insert(index, note)
+                    self._apply_order(roots, None)
+            root_order = note.order
+
+        note.category_id = category_id
+        note.root_order = root_order
+        note.updated_at = timezone.now()
+        note.get_descendants(include_self=True).update(
+            category_id=category_id,
+            root_order=root_order,
+            updated_at=note.updated_at,
+            order=Case(When(pk=note.pk, then=Value(note.order)), default=F('order'), output_field=models.PositiveIntegerField()),
+        )
+        return note
+
+    def archive_completed(self, author_id, before, batch_size=100):
+        """Archive an author's completed subtrees that have not changed since ``before``.
+
+        A subtree is completed when every note in it is scratched out. Only
+        the largest such subtrees are marked, each with one range condition
+        on its tree. Returns the number of notes archived.
+        """
+        with transaction.atomic():
+            rows = list(
+                self.select_for_update()
+                .filter(author_id=author_id, archived_at__isnull=True)
+                .order_by('tree_id', 'lft')
+                .values_list('id', 'parent_id', 'tree_id', 'lft', 'rght', 'scratched_out', 'updated_at')
+            )
+            # Children come after their parents, so walking backwards settles every child first
+            completed = {}
+            incomplete = set()
+            for note_id, parent_id, _, _, _, scratched_out, updated_at in reversed(rows):
+                completed[note_id] = scratched_out and updated_at < before and note_id not in incomplete
+                if not completed[note_id] and parent_id is not None:
+                    incomplete.add(parent_id)
+            tops = [
+                Q(tree_id=tree_id, lft__gte=lft, rght__lte=rght)
+                for note_id, parent_id, tree_id, lft, rght, _, _ in rows
+                if completed[note_id] and not completed.get(parent_id)
+            ]
+            now = timezone.now()
+            archived = 0
+            for start in range(0, len(tops), batch_size):
+                ranges = Q()
+                for condition in tops[start:start + batch_size]:
+                    ranges |= condition
+                archived += self.filter(ranges, author_id=author_id, archived_at__isnull=True).update(archived_at=now)
+            return archived
+
+    def restore_archived(self, note):
+        """Return the archived subtree ``note`` belongs to, as a whole, to the notes list.
+
+        Restored notes count as updated, so delta sync sends them again. A
+        restored tree keeps its place unless another root took its key while
+        it was archived; then it is appended after its category's roots.
+        """
+        top = (
+            self.filter(tree_id=note.tree_id, lft__lte=note.lft, rght__gte=note.rght, archived_at__isnull=False)
+            .order_by('lft')
+            .values_list('id', 'lft', 'rght', 'author_id', 'category_id', 'order')
+            .first()
+        )
+        if top is None:
+            return 0
+        top_id, lft, rght, author_id, category_id, order = top
+        note.archived_at = None
+        restored = self.filter(tree_id=note.tree_id, lft__gte=lft, rght__lte=rght, archived_at__isnull=False).update(
+            archived_at=None, updated_at=timezone.now(),
+        )
+        taken = self.filter(
+            author_id=author_id, category_id=category_id, parent__isnull=True, archived_at__isnull=True, order=order,
+        ).exclude(pk=top_id)
+        if lft == 1 and taken.exists():
+            key = self.next_root_order(author_id, category_id)
+            self.filter(tree_id=note.tree_id).update(
+                root_order=key,
+                order=Case(When(pk=top_id, then=Value(key)), default=F('order'), output_field=models.PositiveIntegerField()),
+            )
+            note.root_order = key
+            if note.pk == top_id:
+                note.order = key
+        return restored
+
+    def next_root_order(self, author_id, category_id):
+        """The key after every root of a category; the category is respaced first when keys run out."""
+        # root_order of any note equals its root's order, so this is an index lookup
+        category_notes = self.filter(author_id=author_id, category_id=category_id)
+        max_order = category_notes.aggregate(models.Max('root_order'))['root_order__max'] or 0
+        if max_order + ORDER_GAP > ORDER_MAX:
+            self.rebalance_roots(author_id, category_id)
+            max_order = category_notes.aggregate(models.Max('root_order'))['root_order__max']
+        return max_order + ORDER_GAP
+
+    def reorder_roots(self, user, ordering):
+        """Put the given root notes in the given order with as few writes as possible.
+
+        Ids the user does not own, and notes that are not roots, are ignored.
+        Usually only the moved notes get a new key. When two neighbours have no
+        room left between them, every root of the notes' categories is
+        respaced, the given notes taking the places the others leave them in
+        the given order. The denormalized ``root_order`` of the affected trees
+        is updated in one statement.
+        """
+        positions = {note_id: position for position, note_id in enumerate(ordering)}
+        with transaction.atomic():
+            roots = list(self._for_ordering().filter(id__in=positions.keys(), author=user, parent__isnull=True))
+            roots.sort(key=lambda note: positions[note.id])
+            keys = sparse_order_keys([note.order for note in roots])
+            if keys is not None:
+                return self._apply_order(roots, keys)
+            ids = {note.id for note in roots}
+            changed = 0
+            for category_id in {note.category_id for note in roots}:
+                ordered = iter([note for note in roots if note.category_id == category_id])
+                category_roots = (
+                    self._for_ordering()
+                    .filter(author=user, category_id=category_id, parent__isnull=True)
+                    .order_by('order', 'tree_id')
+                )
+                changed += self._apply_order([next(ordered) if note.id in ids else note for note in category_roots], None)
+            return changed
+
+    def reset_root_order(self, user, category_id):
+        """Renumber a category's root notes by creation time in one pass.
+
+        Children follow their parents, so only roots are touched.
+        """
+        with transaction.atomic():
+            roots = list(
+                self._for_ordering()
+                .filter(author=user, category_id=category_id, parent__isnull=True)
+                .order_by('created_at', 'id')
+            )
+            return self._apply_order(roots, None)
+
+    def rebalance_roots(self, user, category_id):
+        """Respace a category's root keys evenly, keeping their current order."""
+        with transaction.atomic():
+            roots = list(
+                self._for_ordering()
+                .filter(author=user, category_id=category_id, parent__isnull=True)
+                .order_by('order', 'tree_id')
+            )
+            return self._apply_order(roots, None)
+
+    def _for_ordering(self):
+        return self.select_for_update().only('id', 'order', 'updated_at', 'tree_id', 'parent', 'category')
+
+    def _apply_order(self, roots, keys):
+        if keys is None:
+            keys = [ORDER_GAP * position for position in range(1, len(roots) + 1)]
+        now = timezone.now()
+        changed = []
+        for note, key in zip(roots, keys):
+            if note.order != key:
+                note.order = key
+                note.updated_at = now
+                changed.append(note)
+        if changed:
+            self.bulk_update(changed, ['order', 'updated_at'])
+            # Every note of a moved tree carries its root's order
+            self.filter(tree_id__in=[note.tree_id for note in changed]).update(root_order=Case(
+                *[When(tree_id=note.tree_id, then=Value(note.order)) for note in changed],
+                default=F('root_order'),
+                output_field=models.PositiveIntegerField(),
+            ))
+        return len(changed)
+
+
 class Note(MPTTModel):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="notes")
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="notes")
     order = models.PositiveIntegerField(default=0)
+    # Copy of the root note's order on every node, so whole trees list in index order
+    root_order = models.PositiveIntegerField(default=0)
     scratched_out = models.BooleanField(default=False)
     important = models.BooleanField(default=False)
     parent = TreeForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    # Wide enough for the per-author tree id blocks, see TREE_ID_BLOCK
+    tree_id = models.PositiveBigIntegerField(db_index=True, editable=False)
+    # Set on completed subtrees moved out of the notes list, see NoteManager.archive_completed
+    archived_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = NoteManager()
 
     def save(self, *args, **kwargs):
         # Only compute top-level ordering automatically. Children follow their parents visually.
         if self.order == 0 and self.parent is None:
-            max_order = Note.objects.filter(category=self.category, parent__isnull=True).aggregate(models.Max('order'))['order__max']
-            self.order = (max_order or 0) + 1
+            self.order = Note.objects.next_root_order(self.author_id, self.category_id)
+
+        root_order = self.order if self.parent is None else self.parent.root_order
+        moved = self.pk is not None and root_order != self.root_order
+        self.root_order = root_order
+        # Writing to an archived note, or under one, brings its archived subtree back to the list
+        archived = None
+        if self.archived_at is not None:
+            archived = self
+        elif self.parent is not None and self.parent.archived_at is not None:
+            archived = self.parent
         super().save(*args, **kwargs)
+        if moved:
+            self.get_descendants().update(root_order=root_order)
+        if archived is not None:
+            Note.objects.restore_archived(archived)
 
     def __str__(self):
         return self.content[:20]  # Display the first 20 characters of the content
 
-    class MPTTMeta:
-        order_insertion_by = ['order', 'created_at']
+    class Meta:
+        indexes = [
+            # Serve the notes list in its display order without a sort step. Only active notes are
+            # indexed, so archived ones cost the list nothing however many pile up
+            models.Index(fields=['author', 'root_order', 'tree_id', 'lft'], name='note_author_root_order', condition=Q(archived_at__isnull=True)),
+            models.Index(fields=['author', 'category', 'root_order', 'tree_id', 'lft'], name='note_author_cat_root_order', condition=Q(archived_at__isnull=True)),
+            # The archived notes list and delta sync's archived ids
+            models.Index(fields=['author', 'root_order', 'tree_id', 'lft'], name='note_author_archived_order', condition=Q(archived_at__isnull=False)),
+            models.Index(fields=['author', 'archived_at'], name='note_author_archived_at', condition=Q(archived_at__isnull=False)),
+        ]
+
+
+class NoteTombstone(models.Model):
+    """Remembers deleted notes so delta sync can tell clients to drop them."""
+    RETENTION = timedelta(days=30)
+
+    note_id = models.BigIntegerField()
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="note_tombstones")
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def record(cls, notes):
+        """Write tombstones for ``notes`` and return their ids."""
+        now = timezone.now()
+        rows = list(notes.values_list('id', 'author_id'))
+        cls.objects.bulk_create([cls(note_id=note_id, author_id=author_id, deleted_at=now) for note_id, author_id in rows])
+        return [note_id for note_id, _ in rows]
+
+    @classmethod
+    def purge_expired(cls):
+        """Delete tombstones older than RETENTION; run periodically by "manage.py purge_tombstones"."""
+        deleted, _ = cls.objects.filter(deleted_at__lt=timezone.now() - cls.RETENTION).delete()
+        return deleted
+
+    def __str__(self):
+        return f"{self.note_id} deleted at {self.deleted_at}"
+
+
+class UserVersion(models.Model):
+    """Per-user counter bumped on every write to the user's notes, categories or profile.
+
+    Each bump also wakes the user's event streams through api.events.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="data_version")
+    version = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def current(cls, user_id):
+        return cls.objects.filter(user_id=user_id).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    async def acurrent(cls, user_id):
+        return await cls.objects.filter(user_id=user_id).values_list('version', flat=True).afirst() or 0
+
+    @classmethod
+    def bump(cls, user_id):
+        if not cls.objects.filter(user_id=user_id).update(version=F('version') + 1):
+            _, created = cls.objects.get_or_create(user_id=user_id, defaults={'version': 1})
+            if not created:
+                cls.objects.filter(user_id=user_id).update(version=F('version') + 1)
+        publish_change(user_id)
+
+    def __str__(self):
+        return f"{self.user_id}: v{self.version}"
 
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     profile_picture = models.ImageField(upload_to='profile_pictures/', null=True, blank=True)
+    # Storage paths of the resized copies of profile_picture by size, filled in by api.images
+    picture_variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return self.user.username
@@ -48,7 +522,8 @@ class VisitorPresence(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="visitors")
     visitor_id = models.CharField(max_length=64, unique=True)
     first_seen = models.DateTimeField(auto_now_add=True)
-    last_seen = models.DateTimeField(auto_now=True, db_index=True)
+    # Set explicitly so batched heartbeat writes keep the time they were received
+    last_seen = models.DateTimeField(default=timezone.now, db_index=True)
     user_agent = models.CharField(max_length=255, blank=True)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
 
@@ -57,4 +532,23 @@ class VisitorPresence(models.Model):
         self.save(update_fields=["last_seen"])
 
     def __str__(self):
-        return f"{self.visitor_id} ({self.user.username if self.user else 'anon'})"
\ No newline at end of file
+        return f"{self.visitor_id} ({self.user.username if self.user else 'anon'})"
+
+
+class PresenceDaily(models.Model):
+    """Per-day rollup of VisitorPresence rows purged after the retention window, keyed by last_seen day."""
+    day = models.DateField(unique=True)
+    unique_visitors = models.PositiveIntegerField(default=0)
+    unique_users = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day}: {self.unique_visitors} visitors, {self.unique_users} users"
+
+
+class PresenceUser(models.Model):
+    """One row per user ever seen by presence, so returning users are not counted twice."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="presence")
+    first_seen = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.user_id)
@@ -0,0 +1,10 @@
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+class TreeFormatNegotiation(DefaultContentNegotiation):
+    """Treats ``?format=tree`` as a JSON response shape instead of a renderer format."""
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        if request.query_params.get(self.settings.URL_FORMAT_OVERRIDE) == 'tree':
+            format_suffix = 'json'
+        return super().select_renderer(request, renderers, format_suffix)
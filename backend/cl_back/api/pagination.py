@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination over a unique, index-backed ordering.
+
+    Unless ``always_paginate`` is set, pages are only produced when the client
+    asks for them with ``limit`` or ``cursor``; otherwise the full list is
+    returned as before. The cursor is the
+    ordering key of the last row served, so each page is a range scan instead of
+    an OFFSET.
+    """
+    ordering = ('root_order', 'tree_id', 'lft')
+    limit_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    default_limit = 200
+    max_limit = 1000
+    always_paginate = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if (
+            not self.always_paginate
+            and self.limit_query_param not in request.query_params
+            and self.cursor_query_param not in request.query_params
+        ):
+            return None
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        position = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        results = list(queryset[:self.limit + 1])
+        self.has_next = len(results) > self.limit
+        self.page = results[:self.limit]
+        return self.page
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    def after(self, position):
+        # (a, b, c) > (x, y, z) spelled out so every backend can use the index
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            step = Q(**{f'{field}__gt': position[i]})
+            for previous, value in zip(self.ordering[:i], position[:i]):
+                step &= Q(**{previous: value})
+            condition |= step
+        return condition
+
+    def encode_cursor(self, row):
+        return '.'.join(str(getattr(row, field)) for field in self.ordering)
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            position = [int(part) for part in cursor.split('.')]
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        if len(position) != len(self.ordering):
+            raise NotFound('Invalid cursor')
+        return position
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ArchivedNotePagination(KeysetPagination):
+    """Archived notes grow without bound, so they are always served in pages."""
+    always_paginate = True
+    default_limit = 100
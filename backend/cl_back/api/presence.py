@@ -0,0 +1,283 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import PresenceDaily, PresenceUser, VisitorPresence
+from .workers import process_singleton
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePresenceStore:
+    """Writes every heartbeat straight to VisitorPresence."""
+
+    def record(self, visitor_id, user_id, user_agent, ip_address):
+        visitor, created = VisitorPresence.objects.get_or_create(visitor_id=visitor_id, defaults={
+            'user_id': user_id,
+            'user_agent': user_agent,
+            'ip_address': ip_address,
+        })
+        # Update association if user logs in later
+        if user_id is not None:
+            if created or visitor.user_id != user_id:
+                remember_users({user_id})
+            visitor.user_id = user_id
+        visitor.user_agent = user_agent
+        visitor.ip_address = ip_address
+        visitor.last_seen = timezone.now()
+        visitor.save(update_fields=['user', 'user_agent', 'ip_address', 'last_seen'])
+
+    async def arecord(self, visitor_id, user_id, user_agent, ip_address):
+        await sync_to_async(self.record)(visitor_id, user_id, user_agent, ip_address)
+
+    def flush(self):
+        return 0
+
+
+class CachePresenceStore:
+    """Coalesces heartbeats in Django's cache and writes them out in batches.
+
+    The latest heartbeat of each visitor is kept under its own key. The first
+    heartbeat of a visitor in each flush generation also appends the visitor id
+    to a queue built from an atomic counter, so repeated heartbeats inside the
+    flush interval only overwrite the cached entry. Every flush starts a new
+    generation, so a visitor whose queue slot was lost is queued again by its
+    next heartbeat. ``flush`` drains the queue and upserts the entries into
+    VisitorPresence with at most two bulk statements per batch. With a shared
+    cache (see PRESENCE_CACHE) all workers feed the same queue; with locmem
+    every process keeps and flushes its own.
+    """
+    prefix = 'presence'
+    entry_timeout = 24 * 60 * 60
+    # Only saves queue slots within a generation; an expired marker at worst queues a visitor twice
+    marker_timeout = 5 * 60
+    batch_size = 1000
+
+    def __init__(self, cache_alias='presence'):
+        self.cache = caches[cache_alias]
+
+    def key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+    def record(self, visitor_id, user_id, user_agent, ip_address):
+        entry_key = self.key('visitor', visitor_id)
+        cached = self.cache.get_many([entry_key, self.key('generation')])
+        if user_id is None and cached.get(entry_key):
+            # Keep a login seen earlier in this window; an anonymous beat never clears it
+            user_id = cached[entry_key]['user_id']
+        self.cache.set(entry_key, {
+            'user_id': user_id,
+            'user_agent': user_agent,
+            'ip_address': ip_address,
+            'last_seen': timezone.now(),
+        }, self.entry_timeout)
+
+        generation = cached.get(self.key('generation'), 0)
+        if self.cache.add(self.key('queued', generation, visitor_id), True, self.marker_timeout):
+            if self.cache.add(self.key('seq'), 0, None):
+                # A new (or evicted) counter numbers its queue from 1 again
+                self.cache.set(self.key('flushed'), 0, None)
+            position = self.cache.incr(self.key('seq'))
+            self.cache.set(self.key('queue', position), visitor_id, self.entry_timeout)
+
+    async def arecord(self, visitor_id, user_id, user_agent, ip_address):
+        # A shared cache blocks on the network. Django's async cache methods run the sync ones in a thread one call
+        # at a time, so the whole heartbeat takes a single hop instead
+        await sync_to_async(self.record)(visitor_id, user_id, user_agent, ip_address)
+
+    def flush(self):
+        """Write queued heartbeats to the database. Returns the number of visitors written."""
+        lock_key = self.key('flush-lock')
+        if not self.cache.add(lock_key, True, 5 * 60):
+            return 0
+        written = 0
+        try:
+            # Start a new generation first so a heartbeat racing with this flush queues itself again
+            self.cache.add(self.key('generation'), 0, None)
+            self.cache.incr(self.key('generation'))
+            flushed = self.cache.get(self.key('flushed'), 0)
+            end = self.cache.get(self.key('seq'), 0)
+            if end < flushed:
+                # The counter was restarted while a flush was recording its progress
+                flushed = 0
+            while flushed < end:
+                batch_end = min(end, flushed + self.batch_size)
+                queue_keys = [self.key('queue', n) for n in range(flushed + 1, batch_end + 1)]
+                visitor_ids = set(self.cache.get_many(queue_keys).values())
+                entry_keys = {self.key('visitor', visitor_id): visitor_id for visitor_id in visitor_ids}
+                entries = self.cache.get_many(entry_keys.keys())
+                written += self.write({entry_keys[key]: entry for key, entry in entries.items()})
+                self.cache.delete_many(queue_keys)
+                flushed = batch_end
+                self.cache.set(self.key('flushed'), flushed, None)
+        finally:
+            self.cache.delete(lock_key)
+        return written
+
+    def write(self, entries):
+        with_user, anonymous = [], []
+        for visitor_id, entry in entries.items():
+            visitor = VisitorPresence(
+                visitor_id=visitor_id,
+                user_id=entry['user_id'],
+                user_agent=entry['user_agent'],
+                ip_address=entry['ip_address'],
+                last_seen=entry['last_seen'],
+            )
+            (with_user if entry['user_id'] is not None else anonymous).append(visitor)
+
+        update_fields = ['user_agent', 'ip_address', 'last_seen']
+        if with_user:
+            VisitorPresence.objects.bulk_create(
+                with_user, update_conflicts=True, unique_fields=['visitor_id'], update_fields=update_fields + ['user'],
+            )
+        if anonymous:
+            VisitorPresence.objects.bulk_create(
+                anonymous, update_conflicts=True, unique_fields=['visitor_id'], update_fields=update_fields,
+            )
+        remember_users({visitor.user_id for visitor in with_user})
+        return len(entries)
+
+
+def remember_users(user_ids):
+    """Add users to PresenceUser, which counts them once however many visitor ids they use."""
+    PresenceUser.objects.bulk_create([PresenceUser(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+
+
+def get_presence_stats(window_seconds):
+    """Presence counters, recomputed at most once per PRESENCE_STATS_TTL across all workers.
+
+    The last snapshot never expires from the cache; while one worker refreshes
+    it the others keep serving the previous one.
+    """
+    cache = caches[settings.PRESENCE_CACHE]
+    key = f'presence:stats:{window_seconds}'
+    snapshot = cache.get(key)
+    now = time.time()
+    if snapshot is not None and now - snapshot['computed_at'] < settings.PRESENCE_STATS_TTL:
+        return snapshot['stats']
+    if snapshot is not None and not cache.add(f'{key}:refresh', True, settings.PRESENCE_STATS_TTL):
+        return snapshot['stats']
+
+    stats = compute_presence_stats(window_seconds)
+    cache.set(key, {'computed_at': now, 'stats': stats}, None)
+    cache.delete(f'{key}:refresh')
+    return stats
+
+
+async def aget_presence_stats(window_seconds):
+    """``get_presence_stats`` for async views, in one thread hop; the cache may block on the network."""
+    return await sync_to_async(get_presence_stats)(window_seconds)
+
+
+def compute_presence_stats(window_seconds):
+    """Online counts from the live VisitorPresence rows and lifetime totals from the rollups plus those rows.
+
+    Lifetime visitors are the daily rollups' visitors plus the live rows. A
+    visitor id is only unique within the retention window, so one returning
+    after compaction purged its row is counted again: the total is an upper
+    bound that stays exact for visitors who never come back. Users are counted
+    exactly, from PresenceUser.
+    """
+    threshold = timezone.now() - timedelta(seconds=window_seconds)
+    recent_qs = VisitorPresence.objects.filter(last_seen__gte=threshold)
+    online_authenticated_users = recent_qs.exclude(user__isnull=True).values_list('user', flat=True).distinct().count()
+    online_anonymous_visitors = recent_qs.filter(user__isnull=True).count()
+    rolled_up = PresenceDaily.objects.aggregate(visitors=Sum('unique_visitors'))['visitors'] or 0
+    unique_visitors = rolled_up + VisitorPresence.objects.count()
+
+    return {
+        'online': online_authenticated_users + online_anonymous_visitors,
+        'total': unique_visitors,
+        'online_breakdown': {
+            'authenticated_users': online_authenticated_users,
+            'anonymous_visitors': online_anonymous_visitors,
+        },
+        'totals': {
+            'unique_visitors': unique_visitors,
+            'unique_authenticated_users': PresenceUser.objects.count(),
+        },
+        'window_seconds': window_seconds,
+    }
+
+
+def compact_presence(retention_days, batch_size=1000):
+    """Roll VisitorPresence rows older than the retention window into PresenceDaily and purge them.
+
+    Whole days are handled one at a time, oldest first, in batches of about
+    ``batch_size`` rows. Each batch is added to its day's rollup and deleted in
+    its own transaction, so an interrupted run never counts a row twice and no
+    transaction outgrows a batch. A batch always takes all of a user's rows for
+    the day, so adding up the batches' distinct users counts each user once.
+    The purged rows stay in the lifetime visitor total through the rollup, see
+    ``compute_presence_stats``. Returns the number of rows purged.
+    """
+    cutoff = (timezone.now() - timedelta(days=retention_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    stale = VisitorPresence.objects.filter(last_seen__lt=cutoff)
+    purged = 0
+    while True:
+        oldest = stale.order_by('last_seen').values_list('last_seen', flat=True).first()
+        if oldest is None:
+            return purged
+        day_start = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+        day_rows = stale.filter(last_seen__gte=day_start, last_seen__lt=day_start + timedelta(days=1))
+        while True:
+            with transaction.atomic():
+                rows = list(day_rows.select_for_update().order_by('user', 'id').values_list('id', 'user')[:batch_size])
+                if not rows:
+                    break
+                last_user = rows[-1][1]
+                if len(rows) == batch_size and last_user is not None:
+                    rows = [row for row in rows if row[1] != last_user]
+                    rows += day_rows.select_for_update().filter(user=last_user).values_list('id', 'user')
+                PresenceDaily.objects.get_or_create(day=day_start.date())
+                PresenceDaily.objects.filter(day=day_start.date()).update(
+                    unique_visitors=F('unique_visitors') + len(rows),
+                    unique_users=F('unique_users') + len({user_id for _, user_id in rows} - {None}),
+                )
+                purged += VisitorPresence.objects.filter(id__in=[row_id for row_id, _ in rows]).delete()[0]
+
+
+class PresenceFlusher(threading.Thread):
+    """Daemon thread that periodically flushes a presence store from inside the app process."""
+
+    def __init__(self, store, interval):
+        super().__init__(name='presence-flusher', daemon=True)
+        self.store = store
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+            finally:
+                close_old_connections()
+
+
+def build_presence_store():
+    """A new PRESENCE_STORE, without the in-process flusher."""
+    store_class = import_string(settings.PRESENCE_STORE)
+    if issubclass(store_class, CachePresenceStore):
+        return store_class(settings.PRESENCE_CACHE)
+    return store_class()
+
+
+@process_singleton
+def get_presence_store():
+    """The process's presence store, with a PresenceFlusher started for it when PRESENCE_FLUSH_INTERVAL is set."""
+    store = build_presence_store()
+    if isinstance(store, CachePresenceStore) and settings.PRESENCE_FLUSH_INTERVAL:
+        PresenceFlusher(store, settings.PRESENCE_FLUSH_INTERVAL).start()
+    return store
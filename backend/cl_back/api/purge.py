@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Category, Note, NoteTombstone, UserVersion
+from .workers import BackgroundWorkers, process_singleton
+
+
+def next_purge_batch(category, batch_size):
+    """tree_ids of the category's next whole trees, adding up to about ``batch_size`` notes.
+
+    A tree larger than the batch is still taken whole, on its own.
+    """
+    tree_ids = []
+    total = 0
+    roots = Note.objects.filter(category=category, author_id=category.user_id, parent__isnull=True).order_by('tree_id')
+    for tree_id, lft, rght in roots.values_list('tree_id', 'lft', 'rght')[:batch_size]:
+        size = (rght - lft + 1) // 2
+        if tree_ids and total + size > batch_size:
+            break
+        tree_ids.append(tree_id)
+        total += size
+    return tree_ids
+
+
+def delete_trees(category, tree_ids):
+    """Delete whole trees and leave tombstones for delta sync.
+
+    django-mptt's gap closing is skipped: no other tree shares these
+    tree_ids, so nothing is left to renumber.
+    """
+    notes = Note.objects.filter(category=category, author_id=category.user_id, tree_id__in=tree_ids)
+    NoteTombstone.record(notes)
+    # The SQLite search index follows through its triggers
+    deleted, _ = notes.delete()
+    return deleted
+
+
+@contextmanager
+def write_transaction():
+    """``transaction.atomic()`` that takes SQLite's write lock when it begins.
+
+    A deferred SQLite transaction that reads and then writes fails at once
+    with "database is locked" when a request wrote in between; BEGIN
+    IMMEDIATE waits for the lock instead. Other databases lock rows as they
+    go and get a plain transaction.
+    """
+    connection = transaction.get_connection()
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        with transaction.atomic():
+            yield
+        return
+    mode = connection.transaction_mode
+    connection.transaction_mode = 'IMMEDIATE'
+    try:
+        with transaction.atomic():
+            connection.transaction_mode = mode
+            yield
+    finally:
+        connection.transaction_mode = mode
+
+
+def purge_category(category_id, batch_size=None):
+    """Delete an archived category's notes batch by batch, then the category itself.
+
+    Each batch commits on its own, so no transaction holds locks on more than
+    ``batch_size`` notes. The user's data version is bumped once, with the
+    category's deletion, which tells event streams the purge is done.
+    Returns the number of notes deleted.
+    """
+    batch_size = batch_size or settings.CATEGORY_PURGE_BATCH
+    category = Category.objects.filter(pk=category_id, archived_at__isnull=False).first()
+    if category is None:
+        return 0
+    purged = 0
+    while True:
+        with write_transaction():
+            tree_ids = next_purge_batch(category, batch_size)
+            if tree_ids:
+                purged += delete_trees(category, tree_ids)
+                continue
+            category.delete()
+            UserVersion.bump(category.user_id)
+        return purged
+
+
+@process_singleton
+def get_purge_workers():
+    return BackgroundWorkers(purge_category, settings.CATEGORY_PURGE_WORKERS, 'purge', "Purging category %s failed")
+
+
+def schedule_category_purge(category):
+    """Queue the purge once the archiving transaction has committed."""
+    category_id = category.pk
+    transaction.on_commit(lambda: get_purge_workers().submit(category_id))
@@ -0,0 +1,128 @@
+import re
+from functools import reduce
+from operator import or_
+
+from django.db import connections
+from django.db.models import Q
+
+from .models import Note
+
+# Queries are reduced to plain words on both backends, so user input never reaches
+# the FTS5 or tsquery syntax and both return the notes containing every word
+TERM_RE = re.compile(r'\w+')
+MAX_TERMS = 16
+
+# Migration 0019 creates these; Django rebuilds api_note from scratch for some schema
+# changes on SQLite, which drops them, so they are put back after every migrate
+SQLITE_TRIGGERS = {
+    'api_note_fts_insert': (
+        "CREATE TRIGGER api_note_fts_insert AFTER INSERT ON api_note BEGIN "
+        "INSERT INTO api_note_fts(rowid, content, author_id) VALUES (new.id, new.content, new.author_id); END"
+    ),
+    'api_note_fts_delete': (
+        "CREATE TRIGGER api_note_fts_delete AFTER DELETE ON api_note BEGIN "
+        "INSERT INTO api_note_fts(api_note_fts, rowid, content, author_id) "
+        "VALUES ('delete', old.id, old.content, old.author_id); END"
+    ),
+    'api_note_fts_update': (
+        "CREATE TRIGGER api_note_fts_update AFTER UPDATE OF content, author_id ON api_note BEGIN "
+        "INSERT INTO api_note_fts(api_note_fts, rowid, content, author_id) "
+        "VALUES ('delete', old.id, old.content, old.author_id); "
+        "INSERT INTO api_note_fts(rowid, content, author_id) VALUES (new.id, new.content, new.author_id); END"
+    ),
+}
+
+
+def search_terms(query):
+    return TERM_RE.findall(query.lower())[:MAX_TERMS]
+
+
+class PostgresNoteSearch:
+    """Ranks matches of the generated ``search_vector`` column with ts_rank."""
+    sql = """
+        SELECT note.id, note.tree_id, note.lft, note.rght, ts_rank(note.search_vector, query) AS rank
+        FROM api_note note JOIN api_category category ON category.id = note.category_id, plainto_tsquery('simple', %s) query
+        WHERE note.author_id = %s AND note.search_vector @@ query AND note.archived_at IS NULL AND category.archived_at IS NULL
+        ORDER BY rank DESC, note.id
+        LIMIT %s OFFSET %s
+    """
+
+    def params(self, author_id, terms, limit, offset):
+        return [' '.join(terms), author_id, limit, offset]
+
+
+class SQLiteNoteSearch:
+    """Ranks matches of the ``api_note_fts`` FTS5 table with bm25, ignoring the author column."""
+    sql = """
+        SELECT note.id, note.tree_id, note.lft, note.rght, -bm25(api_note_fts, 1.0, 0.0) AS rank
+        FROM api_note_fts
+        JOIN api_note note ON note.id = api_note_fts.rowid
+        JOIN api_category category ON category.id = note.category_id
+        WHERE api_note_fts MATCH %s AND note.archived_at IS NULL AND category.archived_at IS NULL
+        ORDER BY rank DESC, note.id
+        LIMIT %s OFFSET %s
+    """
+
+    def params(self, author_id, terms, limit, offset):
+        match = ' AND '.join([f'author_id : "{author_id}"'] + [f'content : "{term}"' for term in terms])
+        return [match, limit, offset]
+
+
+BACKENDS = {
+    'postgresql': PostgresNoteSearch,
+    'sqlite': SQLiteNoteSearch,
+}
+
+
+def search_notes(author_id, terms, limit, offset=0, using='default'):
+    """Return ``(id, rank, path)`` for one page of the author's notes matching all ``terms``, best first.
+
+    Archived notes and the notes of deleted categories are left out, as from
+    the notes list.
+
+    ``path`` lists the ``{id, content}`` of the hit's ancestors from its root
+    down; the paths of the whole page are read with one query.
+    """
+    connection = connections[using]
+    backend = BACKENDS[connection.vendor]()
+    with connection.cursor() as cursor:
+        cursor.execute(backend.sql, backend.params(author_id, terms, limit, offset))
+        hits = cursor.fetchall()
+
+    nested = [(tree_id, lft, rght) for _, tree_id, lft, rght, _ in hits if lft > 1]
+    ancestors = []
+    if nested:
+        ancestors = (
+            Note.objects.using(using)
+            .filter(author_id=author_id)
+            .filter(reduce(or_, [Q(tree_id=tree_id, lft__lt=lft, rght__gt=rght) for tree_id, lft, rght in nested]))
+            .order_by('tree_id', 'lft')
+            .values_list('id', 'content', 'tree_id', 'lft', 'rght')
+        )
+    ancestors = list(ancestors)
+
+    return [
+        (note_id, rank, [
+            {'id': ancestor_id, 'content': content}
+            for ancestor_id, content, ancestor_tree, ancestor_lft, ancestor_rght in ancestors
+            if ancestor_tree == tree_id and ancestor_lft < lft and ancestor_rght > rght
+        ])
+        for note_id, tree_id, lft, rght, rank in hits
+    ]
+
+
+def ensure_sqlite_triggers(using='default', **kwargs):
+    """post_migrate handler: restore the FTS5 triggers on SQLite and reindex if any were missing."""
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'api_note_fts'")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'api_note'")
+        missing = set(SQLITE_TRIGGERS) - {name for name, in cursor.fetchall()}
+        for name in sorted(missing):
+            cursor.execute(SQLITE_TRIGGERS[name])
+        if missing:
+            cursor.execute("INSERT INTO api_note_fts(api_note_fts) VALUES ('rebuild')")
@@ -1,6 +1,9 @@
 from django.contrib.auth.models import User
+from django.core.files import File
 from django.core.validators import MinLengthValidator
+from django.db import transaction
 from rest_framework import serializers
+from .images import is_pending, pending_name, schedule_picture_processing
 from .models import Note, Profile, Category
 
 
@@ -11,10 +14,32 @@ def validate_image_size(image):
 
 class ProfileSerializer(serializers.ModelSerializer):
     profile_picture = serializers.ImageField(required=False, allow_null=True, validators=[validate_image_size])
+    picture_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Profile
-        fields = ['profile_picture']
+        fields = ['profile_picture', 'picture_variants']
+
+    def validate_profile_picture(self, image):
+        # Stored as uploaded; a picture worker strips the metadata, camera location included, before it is public
+        # An uploaded file keeps only the base of a name, so the upload is wrapped to carry the pending directory
+        return File(image, name=pending_name(image)) if image else image
+
+    def to_representation(self, profile):
+        data = super().to_representation(profile)
+        if is_pending(profile.profile_picture):
+            data['profile_picture'] = None
+        return data
+
+    def get_picture_variants(self, profile):
+        # Same URL form as profile_picture: absolute when a request is available
+        storage = Profile._meta.get_field('profile_picture').storage
+        request = self.context.get('request')
+        urls = {}
+        for size, path in profile.picture_variants.items():
+            url = storage.url(path)
+            urls[size] = request.build_absolute_uri(url) if request is not None else url
+        return urls
 
 class UserCreateSerializer(serializers.ModelSerializer):
     profile = ProfileSerializer(required=False)
@@ -33,7 +58,9 @@ class UserCreateSerializer(serializers.ModelSerializer):
         user = User(**validated_data)
         user.set_password(password)
         user.save()
-        Profile.objects.create(user=user, **profile_data)
+        profile = Profile.objects.create(user=user, **profile_data)
+        if profile.profile_picture:
+            schedule_picture_processing(profile)
         return user
 
 class UserUpdateSerializer(serializers.ModelSerializer):
@@ -50,8 +77,11 @@ class UserUpdateSerializer(serializers.ModelSerializer):
         instance.username = validated_data.get('username', instance.username)
         instance.save()
 
-        profile.profile_picture = profile_data.get('profile_picture', profile.profile_picture)
-        profile.save()
+        if 'profile_picture' in profile_data:
+            # Variants of the new picture are made in the background; the previous ones are served until then
+            profile.profile_picture = profile_data['profile_picture']
+            profile.save(update_fields=['profile_picture'])
+            schedule_picture_processing(profile)
 
         return instance
 
@@ -60,13 +90,163 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = ["id", "title"]
 
+class UnresolvedPrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """Accepts a primary key without looking it up; the serializer resolves it in validate()."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
 class NoteSerializer(serializers.ModelSerializer):
-    parent = serializers.PrimaryKeyRelatedField(queryset=Note.objects.all(), allow_null=True, required=False)
+    parent = UnresolvedPrimaryKeyField(queryset=Note.objects.none(), allow_null=True, required=False)
+    category = UnresolvedPrimaryKeyField(queryset=Category.objects.none())
     class Meta:
         model = Note
-        fields = ["id", "content", "created_at", "author", "category", "order", "scratched_out", "important", "parent"]
+        fields = ["id", "content", "created_at", "updated_at", "author", "category", "order", "scratched_out", "important", "parent"]
         extra_kwargs = {"author": {"read_only": True}}
 
+    def validate(self, attrs):
+        # Resolve parent and category with one query scoped to the requesting user
+        user = self.context["request"].user
+        instance = self.instance
+        parent_id = attrs.get("parent")
+        category_id = attrs.get("category")
+
+        if parent_id is not None:
+            parent = Note.objects.select_related("category").filter(pk=parent_id, author=user).first()
+            if parent is None or parent.category.archived_at is not None:
+                raise serializers.ValidationError({"parent": ["Invalid pk \"%s\" - object does not exist." % parent_id]})
+            if instance is not None and (parent.pk == instance.pk or parent.is_descendant_of(instance)):
+                raise serializers.ValidationError({"parent": ["A note cannot be moved under itself."]})
+            expected = category_id if category_id is not None else (instance.category_id if instance else None)
+            if "category" in attrs and expected != parent.category_id:
+                raise serializers.ValidationError({"parent": ["Parent must be in the same category."]})
+            attrs["parent"] = parent
+            attrs["category"] = parent.category
+        elif category_id is not None:
+            if instance is not None and instance.parent_id is not None and "parent" not in attrs and category_id != instance.category_id:
+                raise serializers.ValidationError({"category": ["Only top-level notes can change category."]})
+            category = Category.objects.active().filter(pk=category_id, user=user).first()
+            if category is None:
+                raise serializers.ValidationError({"category": ["Invalid pk \"%s\" - object does not exist." % category_id]})
+            attrs["category"] = category
+        return attrs
+
+    def update(self, instance, validated_data):
+        parent_id = getattr(validated_data.pop("parent"), "pk", None) if "parent" in validated_data else instance.parent_id
+        category = validated_data.pop("category", None)
+        category_id = category.pk if category is not None else instance.category_id
+        if parent_id == instance.parent_id and (parent_id is not None or category_id == instance.category_id):
+            return super().update(instance, validated_data)
+
+        # Moves go through move_subtree like the move endpoint: a new root gets a fresh order key among its
+        # category's roots, and the subtree's category and root_order are stamped in one statement
+        with transaction.atomic():
+            notes = Note.objects.lock_trees(self.context["request"].user, {instance.pk, parent_id} - {None})
+            note = notes[instance.pk]
+            parent = notes[parent_id] if parent_id is not None else None
+            Note.objects.move_subtree(note, parent, category_id=category_id if parent is None else None)
+            return super().update(note, validated_data)
+
+    @classmethod
+    def value_columns(cls):
+        return [f"{field}_id" if field in ("author", "category", "parent") else field for field in cls.Meta.fields]
+
+    @classmethod
+    def serialize_values(cls, queryset):
+        """Read-only fast path: the same output as ``many=True`` built from ``values_list`` tuples."""
+        return cls.serialize_rows(queryset.values_list(*cls.value_columns()))
+
+    @classmethod
+    async def aserialize_values(cls, queryset):
+        """``serialize_values`` reading the queryset through the async ORM."""
+        return cls.serialize_rows([values async for values in queryset.values_list(*cls.value_columns())])
+
+    @classmethod
+    def serialize_rows(cls, value_rows):
+        fields = cls.Meta.fields
+        # DateTimeField.to_representation resolves the current timezone per call; do it once
+        tz = serializers.DateTimeField().default_timezone()
+
+        def iso(value):
+            value = (value.astimezone(tz) if tz is not None else value).isoformat()
+            return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+        rows = []
+        for values in value_rows:
+            row = dict(zip(fields, values))
+            row["created_at"] = iso(row["created_at"])
+            row["updated_at"] = iso(row["updated_at"])
+            rows.append(row)
+        return rows
+
+
+def nest_notes(rows):
+    """Nest serialized notes under their parents in one pass.
+
+    ``rows`` must be in tree order (parents before their children, siblings in
+    order), which is how the notes list is sorted.
+    """
+    roots = []
+    by_id = {}
+    for row in rows:
+        row["children"] = []
+        by_id[row["id"]] = row
+        parent = by_id.get(row["parent"])
+        (parent["children"] if parent is not None else roots).append(row)
+    return roots
+
+class NoteReferenceField(serializers.Field):
+    """A note id, or the temp_id of a note created earlier in the same batch."""
+    default_error_messages = {'invalid': 'Must be a note id or a temporary id string.'}
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool) or not isinstance(data, (int, str)) or data == '':
+            self.fail('invalid')
+        return data
+
+    def to_representation(self, value):
+        return value
+
+class NoteBatchOperationSerializer(serializers.Serializer):
+    OPERATIONS = ('create', 'update', 'delete', 'move')
+
+    op = serializers.ChoiceField(choices=OPERATIONS)
+    id = NoteReferenceField(required=False)
+    temp_id = serializers.CharField(required=False, max_length=64)
+    parent = NoteReferenceField(required=False, allow_null=True)
+    category = serializers.IntegerField(required=False)
+    content = serializers.CharField(required=False)
+    order = serializers.IntegerField(required=False, min_value=0)
+    scratched_out = serializers.BooleanField(required=False)
+    important = serializers.BooleanField(required=False)
+
+    def validate(self, attrs):
+        op = attrs['op']
+        if op == 'create':
+            if 'content' not in attrs:
+                raise serializers.ValidationError({'content': ['This field is required.']})
+            if 'category' not in attrs and attrs.get('parent') is None:
+                raise serializers.ValidationError({'category': ['Required unless a parent is given.']})
+        elif 'id' not in attrs:
+            raise serializers.ValidationError({'id': ['This field is required.']})
+        if op == 'move' and 'parent' not in attrs:
+            raise serializers.ValidationError({'parent': ['This field is required.']})
+        if op == 'update':
+            for field in ('parent', 'category'):
+                if field in attrs:
+                    raise serializers.ValidationError({field: ['Use a "move" operation to change this.']})
+        return attrs
+
+class NoteMoveSerializer(serializers.Serializer):
+    parent = serializers.IntegerField(allow_null=True)
+    position = serializers.IntegerField(required=False, min_value=0)
+    category = serializers.IntegerField(required=False)
+
 class ChangePasswordSerializer(serializers.Serializer):
     old_password = serializers.CharField(required=True)
     new_password = serializers.CharField(required=True, validators=[MinLengthValidator(6)])
\ No newline at end of file
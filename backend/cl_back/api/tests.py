@@ -1,3 +1,881 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from datetime import timedelta
+from importlib import import_module, reload
+from io import BytesIO
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from PIL import Image
+from django.test import AsyncClient, TestCase, override_settings
+from django.urls import clear_url_caches, resolve
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import urls as api_urls
+from .authentication import load_user, user_cache_key
+from .benchmark import QUERY_BUDGETS, api_client, endpoints, measure, seed_users
+from .events import get_event_broker
+from .images import PENDING_DIR, process_profile_picture, strip_metadata
+from .metrics import request_metrics
+from .models import (
+    Note, NoteTombstone, Category, ORDER_GAP, ORDER_MAX, TREE_ID_BLOCK, PresenceDaily, Profile, UserVersion, VisitorPresence,
+)
+from .presence import CachePresenceStore, compact_presence, compute_presence_stats, get_presence_store
+from .purge import next_purge_batch, purge_category
+from .search import search_notes
+from .serializers import ProfileSerializer, UserCreateSerializer
+from .transfer import ChecklistImporter, export_records
+from .views import SYNC_EPOCH, NoteListCreate
+
+
+class NoteListPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="planner", password="secret123")
+        cls.category = Category.objects.create(title="Groceries", user=cls.user)
+        for i in range(3):
+            root = Note.objects.create(content=f"root {i}", author=cls.user, category=cls.category)
+            Note.objects.create(content=f"child {i}", author=cls.user, category=cls.category, parent=root)
+
+    def list_queryset(self, **params):
+        request = APIRequestFactory().get("/api/notes/", params)
+        force_authenticate(request, user=self.user)
+        view = NoteListCreate()
+        view.setup(request)
+        view.request = view.initialize_request(request)
+        return view.get_queryset()
+
+    def explain(self, queryset):
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        return queryset.explain()
+
+    def assertIndexOrdered(self, queryset, index_name):
+        plan = self.explain(queryset)
+        self.assertIn(index_name, plan)
+        if connection.vendor == "sqlite":
+            self.assertNotIn("TEMP B-TREE", plan)
+        elif connection.vendor == "postgresql":
+            self.assertNotIn("Sort", plan)
+
+    def test_list_is_an_index_ordered_scan(self):
+        self.assertIndexOrdered(self.list_queryset(), "note_author_root_order")
+
+    def test_category_list_is_an_index_ordered_scan(self):
+        self.assertIndexOrdered(self.list_queryset(category=self.category.id), "note_author_cat_root_order")
+
+    def test_archived_list_is_an_index_ordered_scan(self):
+        archived = Note.objects.filter(author=self.user, archived_at__isnull=False).order_by("root_order", "tree_id", "lft")
+        self.assertIndexOrdered(archived, "note_author_archived_order")
+
+    def test_children_share_their_root_order(self):
+        notes = list(self.list_queryset())
+        self.assertEqual([n.content for n in notes], ["root 0", "child 0", "root 1", "child 1", "root 2", "child 2"])
+        for note in notes:
+            self.assertEqual(note.root_order, note.get_root().order)
+
+    def test_reorder_moves_whole_trees(self):
+        roots = [n.id for n in Note.objects.filter(parent__isnull=True).order_by("order")]
+        Note.objects.reorder_roots(self.user, list(reversed(roots)))
+        notes = list(self.list_queryset())
+        self.assertEqual([n.content for n in notes], ["root 2", "child 2", "root 1", "child 1", "root 0", "child 0"])
+        for note in notes:
+            self.assertEqual(note.root_order, note.get_root().order)
+
+    def test_moving_one_root_rewrites_one_key(self):
+        roots = list(Note.objects.filter(parent__isnull=True).order_by("order"))
+        ordering = [roots[2].id, roots[0].id, roots[1].id]
+        self.assertEqual(Note.objects.reorder_roots(self.user, ordering), 1)
+        self.assertEqual(
+            list(Note.objects.filter(parent__isnull=True).order_by("order").values_list("id", flat=True)),
+            ordering,
+        )
+
+    def test_rebalances_when_keys_run_out(self):
+        first, second, third = Note.objects.filter(parent__isnull=True).order_by("order")
+        Note.objects.filter(pk=first.pk).update(order=1)
+        Note.objects.filter(pk=second.pk).update(order=2)
+        Note.objects.reorder_roots(self.user, [first.id, third.id, second.id])
+        orders = list(Note.objects.filter(parent__isnull=True).order_by("order").values_list("id", "order"))
+        self.assertEqual(orders, [(first.id, ORDER_GAP), (third.id, 2 * ORDER_GAP), (second.id, 3 * ORDER_GAP)])
+
+    def test_a_subset_without_room_respaces_the_whole_category(self):
+        first, second, third = Note.objects.filter(parent__isnull=True).order_by("order")
+        fourth = Note.objects.create(content="root 3", author=self.user, category=self.category)
+        for note, order in ((first, 1), (second, 2), (third, 3)):
+            Note.objects.filter(pk=note.pk).update(order=order)
+        Note.objects.reorder_roots(self.user, [second.id, first.id])
+        orders = list(Note.objects.filter(parent__isnull=True).order_by("order").values_list("id", "order"))
+        self.assertEqual(orders, [(note.id, ORDER_GAP * i) for i, note in enumerate([second, first, third, fourth], 1)])
+
+    def test_appending_past_the_largest_key_respaces_the_category(self):
+        last = Note.objects.filter(parent__isnull=True).order_by("order").last()
+        Note.objects.filter(pk=last.pk).update(order=ORDER_MAX - 1)
+        Note.objects.filter(tree_id=last.tree_id).update(root_order=ORDER_MAX - 1)
+        Note.objects.create(content="root 3", author=self.user, category=self.category)
+        orders = list(Note.objects.filter(parent__isnull=True).order_by("order").values_list("order", flat=True))
+        self.assertEqual(orders, [ORDER_GAP * i for i in range(1, 5)])
+
+    def test_keyset_pages_follow_next_links(self):
+        other = Category.objects.create(title="Errands", user=self.user)
+        Note.objects.create(content="elsewhere", author=self.user, category=other)
+        client = api_client(self.user)
+
+        unpaged = [n["content"] for n in client.get("/api/notes/").data]
+        page = client.get("/api/notes/", {"limit": 4}).data
+        self.assertEqual([n["content"] for n in page["results"]], unpaged[:4])
+        page = client.get(page["next"]).data
+        self.assertEqual([n["content"] for n in page["results"]], unpaged[4:])
+        self.assertIsNone(page["next"])
+
+        contents = []
+        page = client.get("/api/notes/", {"limit": 2, "category": self.category.id}).data
+        while True:
+            contents += [n["content"] for n in page["results"]]
+            if page["next"] is None:
+                break
+            self.assertIn(f"category={self.category.id}", page["next"])
+            page = client.get(page["next"]).data
+        self.assertEqual(contents, ["root 0", "child 0", "root 1", "child 1", "root 2", "child 2"])
+
+        self.assertEqual(client.get("/api/notes/", {"cursor": "not-a-cursor"}).status_code, 404)
+        self.assertEqual(client.get("/api/notes/", {"limit": 2, "cursor": "1.2"}).status_code, 404)
+
+    def test_tree_format_nests_children_under_their_parents(self):
+        child = Note.objects.get(content="child 1")
+        Note.objects.create(content="grandchild 1", author=self.user, category=self.category, parent=child)
+        client = api_client(self.user)
+
+        response = client.get("/api/notes/", {"format": "tree"})
+        self.assertEqual(response.status_code, 200)
+
+        def shape(nodes):
+            return [(node["content"], shape(node["children"])) for node in nodes]
+
+        self.assertEqual(shape(response.json()), [
+            ("root 0", [("child 0", [])]),
+            ("root 1", [("child 1", [("grandchild 1", [])])]),
+            ("root 2", [("child 2", [])]),
+        ])
+
+        etag = response["ETag"]
+        self.assertNotEqual(etag, client.get("/api/notes/")["ETag"])
+        self.assertEqual(client.get("/api/notes/", {"format": "tree"}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        client.post("/api/notes/", {"content": "root 3", "category": self.category.id}, format="json")
+        response = client.get("/api/notes/", {"format": "tree"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(shape(response.json())[-1], ("root 3", []))
+
+    def test_move_places_notes_at_a_position(self):
+        root_0, root_1, root_2 = Note.objects.filter(parent__isnull=True).order_by("order")
+        client = api_client(self.user)
+
+        response = client.post(f"/api/notes/{root_2.id}/move/", {"parent": None, "position": 0}, format="json")
+        self.assertEqual(response.status_code, 200)
+        response = client.post(f"/api/notes/{root_0.id}/move/", {"parent": None, "position": 1}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(Note.objects.filter(parent__isnull=True).order_by("order").values_list("content", flat=True)),
+            ["root 2", "root 0", "root 1"],
+        )
+
+        response = client.post(f"/api/notes/{root_1.id}/move/", {"parent": root_0.id, "position": 0}, format="json")
+        self.assertEqual(response.status_code, 200)
+        root_0.refresh_from_db()
+        self.assertEqual([n.content for n in root_0.get_children()], ["root 1", "child 0"])
+        self.assertEqual(
+            [n.content for n in self.list_queryset()],
+            ["root 2", "child 2", "root 0", "root 1", "child 1", "child 0"],
+        )
+
+    def test_move_rejects_a_parent_inside_the_moved_subtree(self):
+        root = Note.objects.get(content="root 0")
+        child = Note.objects.get(content="child 0")
+        client = api_client(self.user)
+
+        for parent in (root, child):
+            response = client.post(f"/api/notes/{root.id}/move/", {"parent": parent.id}, format="json")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data["parent"], ["A note cannot be moved under itself."])
+        child.refresh_from_db()
+        self.assertEqual(child.parent_id, root.id)
+        self.assertIsNone(Note.objects.get(pk=root.pk).parent_id)
+
+    def test_conditional_gets_answer_304_until_a_write(self):
+        client = api_client(self.user)
+        urls = ("/api/notes/", "/api/categories/", "/api/user/")
+        etags = {}
+        for url in urls:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etags[url] = response["ETag"]
+            response = client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etags[url])
+
+        response = client.post("/api/categories/", {"title": "Errands"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        for url in urls:
+            response = client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etags[url])
+        self.assertEqual([c["title"] for c in client.get("/api/categories/").data], ["Groceries", "Errands"])
+
+    def test_reset_order_renumbers_roots_by_creation_time(self):
+        root_0, root_1, root_2 = Note.objects.filter(parent__isnull=True).order_by("order")
+        now = timezone.now()
+        for note, age in ((root_1, 3), (root_2, 2), (root_0, 1)):
+            Note.objects.filter(pk=note.pk).update(created_at=now - timedelta(days=age))
+        other = Category.objects.create(title="Errands", user=self.user)
+        elsewhere = Note.objects.create(content="elsewhere", author=self.user, category=other)
+        Note.objects.filter(pk=elsewhere.pk).update(order=7, root_order=7)
+        client = api_client(self.user)
+
+        response = client.post("/api/notes/reset-order/", {"category_id": self.category.id}, format="json")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            list(Note.objects.filter(parent__isnull=True, category=self.category).order_by("order").values_list("id", "order")),
+            [(root_1.id, ORDER_GAP), (root_2.id, 2 * ORDER_GAP), (root_0.id, 3 * ORDER_GAP)],
+        )
+        self.assertEqual(
+            [n.content for n in self.list_queryset(category=self.category.id)],
+            ["root 1", "child 1", "root 2", "child 2", "root 0", "child 0"],
+        )
+        for note in self.list_queryset():
+            self.assertEqual(note.root_order, note.get_root().order)
+        self.assertEqual(Note.objects.get(pk=elsewhere.pk).order, 7)
+        self.assertEqual(client.post("/api/notes/reset-order/", {}, format="json").status_code, 400)
+
+
+class TreeIdBlockTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(username=f"author{i}", password="secret123") for i in range(2)]
+        for user in cls.users:
+            category = Category.objects.create(title="Chores", user=user)
+            for i in range(2):
+                root = Note.objects.create(content=f"root {i}", author=user, category=category)
+                Note.objects.create(content=f"child {i}", author=user, category=category, parent=root)
+
+    def tree_fields(self, user):
+        return list(Note.objects.filter(author=user).order_by("id").values_list("tree_id", "lft", "rght", "level"))
+
+    def assertInBlock(self, user):
+        start, end = Note.objects.tree_id_range(user.id)
+        for tree_id, *_ in self.tree_fields(user):
+            self.assertTrue(start < tree_id < end)
+
+    def test_inserts_promotions_and_moves_stay_in_the_authors_block(self):
+        first, second = self.users
+        untouched = self.tree_fields(second)
+        category = first.categories.get()
+        client = api_client(first)
+        Note.objects.create(content="new root", author=first, category=category)
+        child, other_child = Note.objects.filter(author=first, level=1).order_by("id")
+        self.assertEqual(client.patch(f"/api/notes/update/{child.id}/", {"parent": None}, format="json").status_code, 200)
+        self.assertEqual(client.post(f"/api/notes/{other_child.id}/move/", {"parent": None}, format="json").status_code, 200)
+        self.assertEqual(Note.objects.filter(author=first, level=0).count(), 5)
+        self.assertInBlock(first)
+        self.assertEqual(self.tree_fields(second), untouched)
+
+    def test_rebuild_numbers_each_authors_trees_in_its_block_by_order(self):
+        expected = {user.id: self.tree_fields(user) for user in self.users}
+        Note.objects.update(tree_id=1, lft=0, rght=0)
+        Note.objects.rebuild()
+        for user in self.users:
+            self.assertEqual(self.tree_fields(user), expected[user.id])
+
+    def test_migration_moves_tree_ids_into_author_blocks(self):
+        migration = import_module("api.migrations.0018_note_tree_id_per_author")
+        Note.objects.update(tree_id=F("tree_id") % TREE_ID_BLOCK)
+        migration.partition_tree_ids(apps, None)
+        for user in self.users:
+            self.assertInBlock(user)
+
+
+class NoteSyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="syncer", password="secret123")
+        cls.category = Category.objects.create(title="Groceries", user=cls.user)
+        cls.milk = Note.objects.create(content="Milk", author=cls.user, category=cls.category)
+        cls.bread = Note.objects.create(content="Bread", author=cls.user, category=cls.category)
+        Note.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def sync(self, since=None):
+        response = api_client(self.user).get("/api/notes/sync/", {"since": since} if since else {})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_snapshot_then_delta_of_updates_and_deletes(self):
+        snapshot = self.sync()
+        self.assertTrue(snapshot["reset"])
+        self.assertEqual({note["content"] for note in snapshot["notes"]}, {"Milk", "Bread"})
+
+        self.milk.content = "Oat milk"
+        self.milk.save()
+        api_client(self.user).delete(f"/api/notes/delete/{self.bread.id}/")
+        delta = self.sync(snapshot["cursor"])
+        self.assertFalse(delta["reset"])
+        self.assertEqual([note["content"] for note in delta["notes"]], ["Oat milk"])
+        self.assertEqual(delta["deleted"], [self.bread.id])
+
+    def test_moving_a_root_across_categories_sends_its_children(self):
+        work = Category.objects.create(title="Work", user=self.user)
+        carton = Note.objects.create(content="Carton", author=self.user, category=self.category, parent=self.milk)
+        Note.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        cursor = self.sync()["cursor"]
+
+        response = api_client(self.user).patch(f"/api/notes/update/{self.milk.id}/", {"category": work.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        delta = self.sync(cursor)
+        self.assertEqual({note["id"]: note["category"] for note in delta["notes"]}, {self.milk.id: work.id, carton.id: work.id})
+
+    def test_patched_moves_give_new_roots_a_fresh_order_key(self):
+        work = Category.objects.create(title="Work", user=self.user)
+        report = Note.objects.create(content="Report", author=self.user, category=work)
+        crust = Note.objects.create(content="Crust", author=self.user, category=self.category, parent=self.bread)
+        self.assertEqual(report.order, self.milk.order)
+        client = api_client(self.user)
+
+        self.assertEqual(client.patch(f"/api/notes/update/{self.milk.id}/", {"category": work.id}, format="json").status_code, 200)
+        self.assertEqual(client.patch(f"/api/notes/update/{crust.id}/", {"parent": None}, format="json").status_code, 200)
+        for category, contents in ((work, ["Report", "Milk"]), (self.category, ["Bread", "Crust"])):
+            roots = Note.objects.filter(category=category, parent__isnull=True).order_by("order")
+            self.assertEqual([note.content for note in roots], contents)
+            self.assertEqual(len({note.order for note in roots}), len(contents))
+
+    def test_a_write_committing_after_the_read_is_sent_next_time(self):
+        cursor = self.sync()["cursor"]
+        # Stamped just before the read above, but only visible now
+        late = Note.objects.create(content="Eggs", author=self.user, category=self.category)
+        Note.objects.filter(pk=late.pk).update(updated_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([note["id"] for note in self.sync(cursor)["notes"]], [late.id])
+
+    def test_cursors_older_than_tombstone_retention_reset(self):
+        since = timezone.now() - NoteTombstone.RETENTION - timedelta(days=1)
+        delta = self.sync(str((since - SYNC_EPOCH) // timedelta(microseconds=1)))
+        self.assertTrue(delta["reset"])
+        self.assertEqual(len(delta["notes"]), 2)
+
+    def test_expired_tombstones_are_purged_separately(self):
+        NoteTombstone.record(Note.objects.filter(pk=self.milk.pk))
+        NoteTombstone.objects.update(deleted_at=timezone.now() - NoteTombstone.RETENTION - timedelta(days=1))
+        NoteTombstone.record(Note.objects.filter(pk=self.bread.pk))
+        self.assertEqual(NoteTombstone.objects.count(), 2)
+        self.assertEqual(NoteTombstone.purge_expired(), 1)
+        self.assertEqual(list(NoteTombstone.objects.values_list("note_id", flat=True)), [self.bread.id])
+
+
+class NoteBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="batcher", password="secret123")
+        cls.home = Category.objects.create(title="Home", user=cls.user)
+        cls.work = Category.objects.create(title="Work", user=cls.user)
+        cls.trip = Note.objects.create(content="Trip", author=cls.user, category=cls.home)
+        cls.bag = Note.objects.create(content="Bag", author=cls.user, category=cls.home, parent=cls.trip)
+        cls.report = Note.objects.create(content="Report", author=cls.user, category=cls.work)
+
+    def batch(self, *operations):
+        return api_client(self.user).post("/api/notes/batch/", {"operations": list(operations)}, format="json")
+
+    def test_moved_subtrees_are_ordered_in_their_new_category_and_referenced_afterwards(self):
+        response = self.batch(
+            {"op": "move", "id": self.trip.id, "parent": None, "category": self.work.id},
+            {"op": "create", "temp_id": "socks", "parent": self.bag.id, "content": "Socks"},
+            {"op": "create", "temp_id": "memo", "category": self.work.id, "content": "Memo"},
+            {"op": "move", "id": "socks", "parent": "memo"},
+        )
+        self.assertEqual(response.status_code, 200)
+        socks = Note.objects.get(pk=response.data["temp_ids"]["socks"])
+        self.assertEqual(socks.parent_id, response.data["temp_ids"]["memo"])
+
+        notes = Note.objects.filter(author=self.user, category=self.work).order_by("root_order", "tree_id", "lft")
+        self.assertEqual([note.content for note in notes], ["Report", "Trip", "Bag", "Memo", "Socks"])
+        for note in notes:
+            self.assertEqual(note.root_order, note.get_root().order)
+
+    def test_a_failing_operation_rolls_back_the_batch(self):
+        response = self.batch(
+            {"op": "create", "temp_id": "a", "category": self.home.id, "content": "First"},
+            {"op": "create", "temp_id": "a", "category": self.home.id, "content": "Second"},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("temp_id", response.data["operations"][1])
+        response = self.batch(
+            {"op": "move", "id": self.bag.id, "parent": None},
+            {"op": "move", "id": self.trip.id, "parent": 0},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Note.objects.filter(content__in=["First", "Second"]).exists())
+        self.assertEqual(Note.objects.get(pk=self.bag.pk).parent_id, self.trip.id)
+
+    def test_updates_cannot_move_notes(self):
+        for change in ({"parent": self.report.id}, {"category": self.work.id}):
+            with self.subTest(change=change):
+                response = self.batch({"op": "update", "id": self.bag.id, "content": "Backpack", **change})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("move", str(response.data))
+        bag = Note.objects.get(pk=self.bag.pk)
+        self.assertEqual((bag.content, bag.parent_id, bag.category_id), ("Bag", self.trip.id, self.home.id))
+
+
+class NoteArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="archivist", password="secret123")
+        category = Category.objects.create(title="Chores", user=cls.user)
+
+        def note(content, parent=None, scratched_out=True):
+            return Note.objects.create(content=content, author=cls.user, category=category, parent=parent, scratched_out=scratched_out)
+
+        cls.done = note("Done")
+        cls.done_child = note("Done child", cls.done)
+        cls.open = note("Open", scratched_out=False)
+        cls.open_done_child = note("Finished step", cls.open)
+        cls.open_child = note("Next step", cls.open, scratched_out=False)
+        cls.recent = note("Just done")
+        Note.objects.exclude(pk=cls.recent.pk).update(updated_at=timezone.now() - timedelta(days=60))
+
+    def contents(self, response):
+        self.assertEqual(response.status_code, 200)
+        rows = json.loads(response.content)
+        rows = rows["results"] if isinstance(rows, dict) else rows
+        return [row["content"] for row in rows]
+
+    def test_completed_subtrees_move_to_the_archived_list_until_written_to(self):
+        self.assertEqual(Note.objects.archive_completed(self.user.id, timezone.now() - timedelta(days=30)), 3)
+        client = api_client(self.user)
+        self.assertEqual(self.contents(client.get("/api/notes/")), ["Open", "Next step", "Just done"])
+        self.assertEqual(self.contents(client.get("/api/notes/archived/")), ["Done", "Done child", "Finished step"])
+
+        client.patch(f"/api/notes/update/{self.done_child.id}/", {"scratched_out": False}, format="json")
+        self.assertEqual(self.contents(client.get("/api/notes/")), ["Done", "Done child", "Open", "Next step", "Just done"])
+        self.assertEqual(self.contents(client.get("/api/notes/archived/")), ["Finished step"])
+
+    def test_a_restored_tree_whose_key_was_taken_goes_last(self):
+        Note.objects.archive_completed(self.user.id, timezone.now() - timedelta(days=30))
+        Note.objects.filter(pk=self.open.pk).update(order=Note.objects.get(pk=self.done.pk).order)
+        client = api_client(self.user)
+        client.patch(f"/api/notes/update/{self.done.id}/", {"scratched_out": False}, format="json")
+        self.assertEqual(self.contents(client.get("/api/notes/")), ["Open", "Next step", "Just done", "Done", "Done child"])
+
+
+class NoteSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="searcher", password="secret123")
+        category = Category.objects.create(title="Groceries", user=cls.user)
+        cls.root = Note.objects.create(content="Weekly shop", author=cls.user, category=category)
+        cls.aisle = Note.objects.create(content="Dairy aisle", author=cls.user, category=category, parent=cls.root)
+        cls.milk = Note.objects.create(content="Milk, more milk", author=cls.user, category=category, parent=cls.aisle)
+        cls.other = User.objects.create_user(username="other", password="secret123")
+        Note.objects.create(content="milk", author=cls.other, category=Category.objects.create(title="Mine", user=cls.other))
+
+    def test_hits_carry_their_ancestor_path(self):
+        [(note_id, _, path)] = search_notes(self.user.id, ["milk"], 10)
+        self.assertEqual(note_id, self.milk.id)
+        self.assertEqual([ancestor["id"] for ancestor in path], [self.root.id, self.aisle.id])
+
+    def test_index_follows_queryset_updates_and_deletes(self):
+        Note.objects.filter(pk=self.milk.pk).update(content="Oat drink")
+        self.assertEqual(search_notes(self.user.id, ["milk"], 10), [])
+        self.assertEqual(len(search_notes(self.user.id, ["oat"], 10)), 1)
+        self.root.delete()
+        self.assertEqual(search_notes(self.user.id, ["oat"], 10), [])
+
+    def test_archived_notes_are_left_out(self):
+        Note.objects.filter(pk=self.milk.pk).update(archived_at=timezone.now())
+        self.assertEqual(search_notes(self.user.id, ["milk"], 10), [])
+
+
+class ChecklistTransferTests(TestCase):
+    def test_export_imports_as_the_same_trees(self):
+        source = User.objects.create_user(username="source", password="secret123")
+        category = Category.objects.create(title="Trip", user=source)
+        root = Note.objects.create(content="Pack", author=source, category=category)
+        bag = Note.objects.create(content="Bag", author=source, category=category, parent=root)
+        Note.objects.create(content="Socks", author=source, category=category, parent=bag)
+        Note.objects.create(content="Tickets", author=source, category=category, parent=root)
+        Note.objects.create(content="Lock up", author=source, category=category)
+
+        target = User.objects.create_user(username="target", password="secret123")
+        result = ChecklistImporter(target).run(list(export_records(source)))
+        self.assertEqual(result, {"categories": 1, "notes": 5})
+
+        def outline(user):
+            notes = Note.objects.filter(author=user).order_by("root_order", "tree_id", "lft")
+            return [(note.content, note.level, note.rght - note.lft) for note in notes]
+
+        self.assertEqual(outline(target), outline(source))
+        imported = Note.objects.get(author=target, content="Socks")
+        self.assertEqual([note.content for note in imported.get_ancestors()], ["Pack", "Bag"])
+
+
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        [cls.user] = seed_users(1, categories=2, roots=5, depth=3, width=3)
+
+    def test_hot_paths_stay_within_their_query_budgets(self):
+        client = api_client(self.user)
+        for name, prepare in endpoints(self.user).items():
+            with self.subTest(endpoint=name):
+                measure(client, prepare)
+                _, queries = measure(client, prepare)
+                self.assertLessEqual(queries, QUERY_BUDGETS[name])
+
+
+class PresenceStoreTests(TestCase):
+    def setUp(self):
+        self.store = CachePresenceStore(settings.PRESENCE_CACHE)
+        self.store.cache.clear()
+        self.addCleanup(self.store.cache.clear)
+        self.user = User.objects.create_user(username="visitor", password="secret123")
+
+    def test_heartbeats_coalesce_until_the_flush(self):
+        self.store.record("tab-1", self.user.id, "agent", "127.0.0.1")
+        self.store.record("tab-1", None, "agent 2", "127.0.0.1")
+        self.store.record("tab-2", None, "agent", "127.0.0.1")
+        self.assertFalse(VisitorPresence.objects.exists())
+        self.assertEqual(self.store.flush(), 2)
+        self.assertEqual(self.store.flush(), 0)
+        visitor = VisitorPresence.objects.get(visitor_id="tab-1")
+        self.assertEqual((visitor.user_id, visitor.user_agent), (self.user.id, "agent 2"))
+
+    def test_a_visitor_whose_queue_slot_was_lost_is_queued_by_its_next_heartbeat(self):
+        self.store.record("tab-1", None, "agent", "127.0.0.1")
+        self.store.cache.delete(self.store.key("queue", 1))
+        self.assertEqual(self.store.flush(), 0)
+        self.store.record("tab-1", None, "agent", "127.0.0.1")
+        self.assertEqual(self.store.flush(), 1)
+
+    def test_visitors_and_users_are_counted_once_across_workers(self):
+        # Two processes with their own caches buffering the same returning visitor
+        other = CachePresenceStore("default")
+        self.addCleanup(other.cache.clear)
+        for store in (self.store, other):
+            store.record("tab-1", self.user.id, "agent", "127.0.0.1")
+            store.record("tab-2", None, "agent", "127.0.0.1")
+        self.store.flush()
+        other.flush()
+        totals = compute_presence_stats(60)["totals"]
+        self.assertEqual((totals["unique_visitors"], totals["unique_authenticated_users"]), (2, 1))
+
+    def test_the_flush_command_refuses_a_per_process_cache(self):
+        self.store.record("tab-1", None, "agent", "127.0.0.1")
+        with self.assertRaises(CommandError):
+            call_command("flush_presence")
+
+    def test_an_evicted_queue_counter_starts_over(self):
+        self.store.record("tab-1", None, "agent", "127.0.0.1")
+        self.store.flush()
+        self.store.cache.delete(self.store.key("seq"))
+        self.store.record("tab-2", None, "agent", "127.0.0.1")
+        self.assertEqual(self.store.flush(), 1)
+        self.assertTrue(VisitorPresence.objects.filter(visitor_id="tab-2").exists())
+
+
+class PresenceCompactionTests(TestCase):
+    def setUp(self):
+        self.store = CachePresenceStore(settings.PRESENCE_CACHE)
+        self.store.cache.clear()
+        self.addCleanup(self.store.cache.clear)
+        self.users = [User.objects.create_user(username=f"visitor{i}", password="secret123") for i in range(2)]
+
+    def test_batches_count_each_user_once_per_day_and_totals_add_the_rollups_to_the_live_rows(self):
+        for i, user in enumerate([self.users[0]] * 3 + [self.users[1], None]):
+            self.store.record(f"tab-{i}", user and user.id, "agent", "127.0.0.1")
+        self.store.flush()
+        day = timezone.now() - timedelta(days=40)
+        VisitorPresence.objects.update(last_seen=day)
+
+        self.assertEqual(compact_presence(30, batch_size=2), 5)
+        rollup = PresenceDaily.objects.get()
+        self.assertEqual((rollup.day, rollup.unique_visitors, rollup.unique_users), (day.date(), 5, 2))
+        self.assertFalse(VisitorPresence.objects.exists())
+
+        self.store.record("tab-0", self.users[0].id, "agent", "127.0.0.1")
+        self.store.record("tab-5", None, "agent", "127.0.0.1")
+        self.store.flush()
+        # tab-0 came back after its row was rolled up, so it counts again; its user does not
+        totals = compute_presence_stats(60)["totals"]
+        self.assertEqual((totals["unique_visitors"], totals["unique_authenticated_users"]), (7, 2))
+
+
+class CategoryPurgeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        [cls.user] = seed_users(1, categories=2, roots=3, depth=2, width=2)
+        cls.doomed, cls.kept = cls.user.categories.order_by("id")
+
+    def test_delete_archives_and_the_purge_removes_whole_trees_in_batches(self):
+        doomed_ids = set(self.doomed.notes.values_list("id", flat=True))
+        # The purge is queued for after the commit, which a TestCase never reaches
+        self.assertEqual(api_client(self.user).delete(f"/api/categories/delete/{self.doomed.id}/").status_code, 204)
+        self.assertEqual(list(Category.objects.active().filter(user=self.user)), [self.kept])
+
+        # Three trees of three notes: two fit a batch of six notes, and a tree larger than the batch is taken whole
+        self.assertEqual(len(next_purge_batch(self.doomed, 6)), 2)
+        self.assertEqual(len(next_purge_batch(self.doomed, 1)), 1)
+
+        version = UserVersion.current(self.user.id)
+        self.assertEqual(purge_category(self.doomed.id, batch_size=6), len(doomed_ids))
+        self.assertEqual(UserVersion.current(self.user.id), version + 1)
+        self.assertFalse(Category.objects.filter(pk=self.doomed.id).exists())
+        self.assertFalse(Note.objects.filter(id__in=doomed_ids).exists())
+        self.assertEqual(set(NoteTombstone.objects.values_list("note_id", flat=True)), doomed_ids)
+        self.assertEqual(Note.objects.filter(category=self.kept).count(), 9)
+
+    def test_notes_of_a_deleted_category_are_gone_before_the_purge(self):
+        client = api_client(self.user)
+        doomed_ids = set(self.doomed.notes.values_list("id", flat=True))
+        doomed_root = self.doomed.notes.filter(parent__isnull=True).first()
+        Note.objects.filter(pk=doomed_root.pk).update(content="Doomed errand")
+        cursor = client.get("/api/notes/sync/").data["cursor"]
+        self.assertEqual(client.delete(f"/api/categories/delete/{self.doomed.id}/").status_code, 204)
+
+        listed = {note["id"] for note in client.get("/api/notes/").data}
+        self.assertEqual(listed, set(self.kept.notes.values_list("id", flat=True)))
+        delta = client.get("/api/notes/sync/", {"since": cursor}).data
+        self.assertEqual(set(delta["deleted"]), doomed_ids)
+        self.assertEqual(client.get("/api/notes/search/", {"q": "doomed"}).data["results"], [])
+        response = client.patch(f"/api/notes/update/{doomed_root.id}/", {"content": "Saved"}, format="json")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(client.delete(f"/api/notes/delete/{doomed_root.id}/").status_code, 404)
+        self.assertEqual(client.post(f"/api/notes/{doomed_root.id}/move/", {"parent": None}, format="json").status_code, 404)
+        self.assertEqual(Note.objects.filter(id__in=doomed_ids).count(), len(doomed_ids))
+
+    def test_notes_cannot_be_moved_or_added_into_an_archived_category(self):
+        client = api_client(self.user)
+        self.assertEqual(client.delete(f"/api/categories/delete/{self.doomed.id}/").status_code, 204)
+        doomed_root = self.doomed.notes.filter(parent__isnull=True).first()
+        kept_root = self.kept.notes.filter(parent__isnull=True).first()
+
+        response = client.post(f"/api/notes/{kept_root.id}/move/", {"parent": doomed_root.id}, format="json")
+        self.assertEqual(response.status_code, 400)
+        for operation in (
+            {"op": "create", "parent": doomed_root.id, "content": "Late"},
+            {"op": "move", "id": kept_root.id, "parent": doomed_root.id},
+            {"op": "move", "id": kept_root.id, "parent": None, "category": self.doomed.id},
+        ):
+            with self.subTest(operation=operation):
+                response = client.post("/api/notes/batch/", {"operations": [operation]}, format="json")
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(Note.objects.filter(category=self.kept).count(), 9)
+
+
+@override_settings(METRICS_SAMPLE_RATE=1)
+class RequestMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        [cls.user] = seed_users(1, categories=1, roots=2, depth=1, width=1)
+        cls.admin = User.objects.create_user(username="admin", password="secret123", is_staff=True)
+
+    def setUp(self):
+        request_metrics.reset()
+        self.addCleanup(request_metrics.reset)
+
+    def test_sampled_requests_are_timed_and_exported_to_admins(self):
+        response = api_client(self.user).get("/api/categories/")
+        timings = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(timings, ["db", "encode", "app", "total"])
+
+        self.assertEqual(api_client(self.user).get("/api/metrics/").status_code, 403)
+        response = api_client(self.admin).get("/api/metrics/")
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('cl_back_request_queries_count{view="CategoryListCreate"} 1', lines)
+        self.assertIn('cl_back_request_encode_seconds_count{view="CategoryListCreate"} 1', lines)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_a_zero_sample_rate_leaves_the_middleware_out(self):
+        response = api_client(self.user).get("/api/categories/")
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(request_metrics.prometheus().count("_count{"), 0)
+
+
+class ProfilePictureTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+    def test_uploads_are_public_only_once_a_worker_has_stripped_their_metadata(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotated a quarter turn
+        exif[0x8825] = {2: (51.0, 30.0, 0.0)}  # GPS latitude
+        buffer = BytesIO()
+        Image.new("RGB", (40, 20), "red").save(buffer, "JPEG", exif=exif, comment=b"Taken at home")
+        upload = SimpleUploadedFile("photo.jpg", buffer.getvalue(), content_type="image/jpeg")
+
+        serializer = UserCreateSerializer(data={"username": "photographer", "password": "secret123", "profile": {"profile_picture": upload}})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        profile = serializer.save().profile
+        self.assertTrue(profile.profile_picture.name.startswith(f"{PENDING_DIR}/"))
+        self.assertIsNone(ProfileSerializer(profile).data["profile_picture"])
+        with profile.profile_picture.open("rb") as stored:
+            self.assertEqual(stored.read(), buffer.getvalue())
+
+        pending = profile.profile_picture.path
+        process_profile_picture(profile.pk)
+        profile.refresh_from_db()
+        self.assertFalse(os.path.exists(pending))
+        self.assertIsNotNone(ProfileSerializer(profile).data["profile_picture"])
+        self.assertEqual(set(profile.picture_variants), {str(size) for size in settings.PROFILE_PICTURE_SIZES})
+        with Image.open(profile.profile_picture.path) as stored, Image.open(BytesIO(buffer.getvalue())) as original:
+            self.assertEqual(dict(stored.getexif()), {0x0112: 6})
+            self.assertNotIn("comment", stored.info)
+            # Not re-encoded: the pixels are those of the upload
+            self.assertEqual(stored.tobytes(), original.tobytes())
+
+    def test_stripping_keeps_every_frame_of_an_animation(self):
+        exif = Image.Exif()
+        exif[0x8825] = {2: (51.0, 30.0, 0.0)}
+        frames = [Image.new("RGB", (16, 16), colour) for colour in ("red", "blue")]
+        for image_format in ("WEBP", "PNG", "GIF"):
+            with self.subTest(image_format=image_format):
+                buffer = BytesIO()
+                frames[0].save(buffer, image_format, save_all=True, append_images=frames[1:], exif=exif, comment=b"Home")
+                with Image.open(BytesIO(strip_metadata(buffer.getvalue()))) as stripped:
+                    self.assertEqual(stripped.n_frames, 2)
+                    self.assertEqual(dict(stripped.getexif()), {})
+                    self.assertNotIn("comment", stripped.info)
+
+
+class CachedAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        [cls.user] = seed_users(1, categories=1, roots=1, depth=1, width=1)
+
+    def setUp(self):
+        # Rolled-back users' ids are handed out again, so no cached user may outlive a test
+        cache = caches[settings.AUTH_USER_CACHE]
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_warm_requests_skip_the_user_and_profile_queries_until_the_user_changes(self):
+        client = api_client(self.user)
+        self.assertEqual(client.get("/api/user/").status_code, 200)
+        # Only the data version read for the ETag is left
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get("/api/user/").status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(client.get("/api/user/").status_code, 401)
+        self.assertFalse(load_user(self.user.id).is_active)
+
+    def test_cached_users_leave_the_password_hash_out_and_keep_simplejwts_checks(self):
+        Profile.objects.create(user=self.user)
+        with patch.object(jwt_settings, "CHECK_REVOKE_TOKEN", True):
+            client = api_client(self.user)
+            self.assertEqual(client.get("/api/user/").status_code, 200)
+            self.assertNotIn(self.user.password, repr(caches[settings.AUTH_USER_CACHE].get(user_cache_key(self.user.id))))
+
+            # Saving a cached user keeps the password it never loaded
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(client.patch("/api/user/update/", {"username": "renamed"}, format="json").status_code, 200)
+            self.assertTrue(User.objects.get(pk=self.user.pk).check_password("password"))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.put("/api/user/change-password/", {"old_password": "password", "new_password": "secret456"}, format="json")
+            self.assertEqual(response.status_code, 200)
+            response = client.get("/api/user/")
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.data["code"], "password_changed")
+
+
+class ServerModeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="poller", password="secret123")
+        cls.note = Note.objects.create(content="Milk", author=cls.user, category=Category.objects.create(title="Groceries", user=cls.user))
+
+    def route(self, mode):
+        with override_settings(SERVER_MODE=mode):
+            reload(api_urls)
+            reload(import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    def setUp(self):
+        self.addCleanup(self.route, settings.SERVER_MODE)
+        caches[settings.PRESENCE_CACHE].clear()
+        self.addCleanup(caches[settings.PRESENCE_CACHE].clear)
+
+    def test_wsgi_mode_keeps_the_sync_views(self):
+        self.route("wsgi")
+        self.assertEqual(resolve("/api/notes/").func.view_class, NoteListCreate)
+        self.assertEqual(api_client(self.user).post("/api/presence/heartbeat/", {"visitor_id": "tab-1"}, format="json").status_code, 204)
+
+    async def test_asgi_mode_serves_the_async_views(self):
+        await sync_to_async(self.route)("asgi")
+        self.assertEqual(resolve("/api/notes/").func.view_class.__module__, "api.async_views")
+        headers = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+        client = AsyncClient()
+
+        response = await client.get("/api/notes/", headers=headers)
+        self.assertEqual([row["content"] for row in json.loads(response.content)], ["Milk"])
+        response = await client.get("/api/notes/", headers={**headers, "If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+        response = await client.post("/api/presence/heartbeat/", {"visitor_id": "tab-1"}, content_type="application/json", headers=headers)
+        self.assertEqual(response.status_code, 204)
+        await sync_to_async(get_presence_store().flush)()
+        response = await client.get("/api/presence/stats/")
+        self.assertEqual(json.loads(response.content)["online_breakdown"], {"authenticated_users": 1, "anonymous_visitors": 0})
+
+
+class NoteEventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="streamer", password="secret123")
+        cls.category = Category.objects.create(title="Groceries", user=cls.user)
+        cls.note = Note.objects.create(content="Milk", author=cls.user, category=cls.category)
+
+    async def open_stream(self, **headers):
+        headers["Authorization"] = f"Bearer {AccessToken.for_user(self.user)}"
+        response = await AsyncClient().get("/api/notes/events/", headers=headers)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        return response.streaming_content
+
+    async def next_event(self, stream):
+        while True:
+            chunk = (await anext(stream)).decode()
+            if chunk.startswith("id: "):
+                lines = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+                return lines["id"], json.loads(lines["data"])
+
+    async def test_resumes_from_last_event_id_and_pushes_later_writes(self):
+        stream = await self.open_stream()
+        cursor, first = await self.next_event(stream)
+        self.assertEqual([note["id"] for note in first["notes"]], [self.note.id])
+        self.assertEqual(first["categories"], [{"id": self.category.id, "title": "Groceries"}])
+        await stream.aclose()
+
+        self.note.content = "Oat milk"
+        await self.note.asave()
+        stream = await self.open_stream(**{"Last-Event-ID": cursor})
+        _, missed = await self.next_event(stream)
+        self.assertEqual([note["content"] for note in missed["notes"]], ["Oat milk"])
+
+        bread = await sync_to_async(Note.objects.create)(content="Bread", author=self.user, category=self.category)
+        get_event_broker().publish(self.user.id)
+        _, pushed = await self.next_event(stream)
+        self.assertEqual([note["id"] for note in pushed["notes"]], [bread.id])
+        await stream.aclose()
@@ -0,0 +1,200 @@
+import json
+from collections import defaultdict
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .models import Category, Note, ORDER_GAP
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def export_records(user):
+    """Yield a user's categories, then their notes in list order, as plain dicts.
+
+    Both are read through ``.iterator()``, so memory stays flat however many
+    notes there are. Parents always come before their children.
+    """
+    for category_id, title in Category.objects.active().filter(user=user).order_by('id').values_list('id', 'title').iterator():
+        yield {'type': 'category', 'id': category_id, 'title': title}
+
+    notes = (
+        Note.objects.filter(author=user, category__archived_at__isnull=True)
+        .order_by('root_order', 'tree_id', 'lft')
+        .values_list('id', 'category_id', 'parent_id', 'content', 'order', 'scratched_out', 'important', 'created_at')
+    )
+    for note_id, category_id, parent_id, content, order, scratched_out, important, created_at in notes.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield {
+            'type': 'note',
+            'id': note_id,
+            'category': category_id,
+            'parent': parent_id,
+            'content': content,
+            'order': order,
+            'scratched_out': scratched_out,
+            'important': important,
+            'created_at': created_at.isoformat(),
+        }
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def json_chunks(records):
+    """The same records as one JSON array, still written a record at a time."""
+    separator = '[\n'
+    for record in records:
+        yield separator + json.dumps(record)
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+
+def parse_ndjson(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+class ChecklistImporter:
+    """Adds exported categories and notes to a user's account as new rows.
+
+    Ids in the records only link them to each other. Notes must come after
+    their category and parent, as the export writes them. Complete trees are
+    buffered and written with one ``bulk_create`` per tree level per batch,
+    with ``lft``/``rght``/``level``/``tree_id`` computed up front instead of
+    one MPTT insert per node. Categories are always created new, so root notes
+    get fresh sparse order keys in file order. The whole import is one
+    transaction.
+    """
+    batch_size = 2000
+
+    def __init__(self, user):
+        self.user = user
+        self.categories = {}
+        self.pending_categories = []
+        self.trees = []
+        self.buffered = 0
+        self.tree = None
+        self.last_order = {}
+        self.notes = 0
+
+    def run(self, records):
+        with transaction.atomic():
+            self.next_tree_id = Note.objects.next_tree_id(self.user.id)
+            for index, record in enumerate(records):
+                try:
+                    self.add(record)
+                except ValidationError as exc:
+                    raise ValidationError({'records': {index: exc.detail}})
+            self.close_tree()
+            self.flush()
+            self.save_categories()
+        return {'categories': len(self.categories), 'notes': self.notes}
+
+    def add(self, record):
+        if not isinstance(record, dict):
+            raise ValidationError(['Each record must be a JSON object.'])
+        for key in ('id', 'category', 'parent'):
+            if isinstance(record.get(key), (bool, float, list, dict)):
+                raise ValidationError({key: ['Must be a number or a string.']})
+        kind = record.get('type')
+        if kind == 'category':
+            self.add_category(record)
+        elif kind == 'note':
+            self.add_note(record)
+        else:
+            raise ValidationError({'type': ['Must be "category" or "note".']})
+
+    def add_category(self, record):
+        title = record.get('title')
+        if not isinstance(title, str) or not title or len(title) > 100:
+            raise ValidationError({'title': ['Must be a non-empty string of at most 100 characters.']})
+        if record.get('id') in self.categories:
+            raise ValidationError({'id': [f"Category {record.get('id')} appears twice."]})
+        category = Category(title=title, user=self.user)
+        self.categories[record.get('id')] = category
+        self.pending_categories.append(category)
+
+    def add_note(self, record):
+        content = record.get('content')
+        if not isinstance(content, str):
+            raise ValidationError({'content': ['This field is required.']})
+        category = self.categories.get(record.get('category'))
+        if category is None:
+            raise ValidationError({'category': [f"Category {record.get('category')} does not come before this note."]})
+        # Categories get their ids before the first note that points at them is written
+        self.save_categories()
+
+        note = Note(
+            author=self.user,
+            category=category,
+            content=content,
+            scratched_out=bool(record.get('scratched_out', False)),
+            important=bool(record.get('important', False)),
+        )
+        parent_id = record.get('parent')
+        if parent_id is None:
+            self.close_tree()
+            self.tree = {'root': note, 'children': defaultdict(list), 'nodes': {}}
+            self.last_order[category.id] = self.last_order.get(category.id, 0) + ORDER_GAP
+            note.order = self.last_order[category.id]
+        else:
+            parent = self.tree['nodes'].get(parent_id) if self.tree else None
+            if parent is None:
+                raise ValidationError({'parent': [f'Note {parent_id} does not come before this note in the same tree.']})
+            if parent.category is not category:
+                raise ValidationError({'parent': ['Parent must be in the same category.']})
+            note.parent = parent
+            self.tree['children'][parent_id].append(note)
+        self.tree['nodes'][record.get('id')] = note
+        self.buffered += 1
+        self.notes += 1
+
+    def close_tree(self):
+        if self.tree is None:
+            return
+        self.trees.append(self.tree)
+        self.tree = None
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        levels = defaultdict(list)
+        for tree in self.trees:
+            root = tree['root']
+            children = {id(parent): tree['children'][old_id] for old_id, parent in tree['nodes'].items()}
+            tree_id = self.next_tree_id
+            self.next_tree_id += 1
+            # Iterative depth-first walk numbering lft on the way down and rght on the way up
+            counter = 1
+            root.lft, root.level = counter, 0
+            stack = [(root, iter(children[id(root)]))]
+            while stack:
+                node, remaining = stack[-1]
+                child = next(remaining, None)
+                if child is None:
+                    counter += 1
+                    node.rght = counter
+                    node.tree_id = tree_id
+                    node.root_order = root.order
+                    levels[node.level].append(node)
+                    stack.pop()
+                else:
+                    counter += 1
+                    child.lft, child.level = counter, node.level + 1
+                    stack.append((child, iter(children[id(child)])))
+        for level in sorted(levels):
+            Note.objects.bulk_create(levels[level], batch_size=self.batch_size)
+        self.trees = []
+        self.buffered = 0
+
+    def save_categories(self):
+        if self.pending_categories:
+            Category.objects.bulk_create(self.pending_categories)
+            self.pending_categories = []
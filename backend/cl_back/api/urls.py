@@ -1,19 +1,34 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+if settings.SERVER_MODE == 'asgi':
+    NoteList, PresenceHeartbeat, PresenceStats = async_views.NoteList, async_views.PresenceHeartbeat, async_views.PresenceStats
+else:
+    NoteList, PresenceHeartbeat, PresenceStats = views.NoteListCreate, views.PresenceHeartbeat, views.PresenceStats
 
 urlpatterns = [
-    path("notes/", views.NoteListCreate.as_view(), name="note-list"),
+    path("notes/", NoteList.as_view(), name="note-list"),
+    path("notes/archived/", views.ArchivedNoteList.as_view(), name="note-archived"),
+    path("notes/sync/", views.NoteSync.as_view(), name="note-sync"),
+    path("notes/events/", async_views.NoteEvents.as_view(), name="note-events"),
+    path("notes/search/", views.NoteSearch.as_view(), name="note-search"),
+    path("notes/batch/", views.NoteBatchUpdate.as_view(), name="note-batch"),
     path("notes/delete/<int:pk>/", views.NoteDelete.as_view(), name="delete-note"),
     path("notes/update/<int:pk>/", views.NoteUpdate.as_view(), name="update-note"),
+    path("notes/<int:pk>/move/", views.NoteMove.as_view(), name="move-note"),
     path("notes/order/", views.NoteOrderUpdate.as_view(), name="update-note-order"),
     path("notes/reset-order/", views.NoteResetOrder.as_view(), name="reset-note-order"),
     path("categories/", views.CategoryListCreate.as_view(), name="category-list"),
     path("categories/delete/<int:pk>/", views.CategoryDelete.as_view(), name="delete-category"),
     path("categories/update/<int:pk>/", views.CategoryUpdate.as_view(), name="update-category"),
+    path("export/", views.ChecklistExport.as_view(), name="checklist-export"),
+    path("import/", views.ChecklistImport.as_view(), name="checklist-import"),
     path("user/", views.UserDetailView.as_view(), name="user-detail"),
     path("user/register/", views.CreateUserView.as_view(), name="register"),
     path("user/update/", views.UserUpdateView.as_view(), name="user-update"),
     path("user/change-password/", views.ChangePasswordView.as_view(), name="change-password"),
-    path("presence/heartbeat/", views.PresenceHeartbeat.as_view(), name="presence-heartbeat"),
-    path("presence/stats/", views.PresenceStats.as_view(), name="presence-stats"),
+    path("presence/heartbeat/", PresenceHeartbeat.as_view(), name="presence-heartbeat"),
+    path("presence/stats/", PresenceStats.as_view(), name="presence-stats"),
+    path("metrics/", views.RequestMetricsView.as_view(), name="metrics"),
 ]
\ No newline at end of file
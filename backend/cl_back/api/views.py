@@ -1,32 +1,75 @@
 from django.contrib.auth.models import User
 from rest_framework import generics, permissions, status
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
-from .serializers import UserCreateSerializer, UserUpdateSerializer, NoteSerializer, ChangePasswordSerializer, CategorySerializer
-from .models import Note, Category, VisitorPresence
+from .serializers import UserCreateSerializer, UserUpdateSerializer, NoteSerializer, ChangePasswordSerializer, CategorySerializer, NoteBatchOperationSerializer, NoteMoveSerializer, nest_notes
+from .batch import NoteBatch
+from .models import Note, NoteTombstone, Category
+from .mixins import ConditionalGetMixin, VersionedWriteMixin
+from .pagination import ArchivedNotePagination, KeysetPagination
+from .negotiation import TreeFormatNegotiation
+from .metrics import request_metrics
+from .presence import get_presence_stats, get_presence_store
+from .purge import schedule_category_purge
+from .search import search_notes, search_terms
+from .transfer import ChecklistImporter, export_records, json_chunks, ndjson_lines, parse_ndjson
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import OuterRef, Subquery
-
-class NoteListCreate(generics.ListCreateAPIView):
+import json
+from django.db import transaction
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+# Sync cursors are microseconds since this instant, which keeps them URL-safe
+SYNC_EPOCH = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+# Rows are stamped when written but only seen by others once their transaction commits. Cursors trail
+# the read by this margin, so a write committing up to this late is sent next time instead of never
+SYNC_COMMIT_MARGIN = timedelta(seconds=5)
+
+def filter_by_category(notes, params):
+    """``notes`` narrowed to the ``?category=`` in ``params``, when there is one."""
+    category = params.get('category')
+    if category is None:
+        return notes
+    try:
+        return notes.filter(category_id=int(category))
+    except ValueError:
+        raise ValidationError({"category": ["A valid integer is required."]})
+
+
+def visitor_id_error(visitor_id):
+    """Why a heartbeat's visitor_id is rejected, or None when it is valid."""
+    if not visitor_id:
+        return "visitor_id is required"
+    if not isinstance(visitor_id, str) or len(visitor_id) > 64:
+        return "visitor_id must be a string of at most 64 characters"
+    return None
+
+
+class NoteListCreate(ConditionalGetMixin, VersionedWriteMixin, generics.ListCreateAPIView):
     serializer_class = NoteSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
+    content_negotiation_class = TreeFormatNegotiation
 
     def get_queryset(self):
         user = self.request.user
+        notes = Note.objects.in_active_categories().filter(author=user, archived_at__isnull=True)
+        notes = filter_by_category(notes, self.request.query_params)
+
         # Order entire trees by their root note's "order" and preserve subtree order via lft
-        root_order_subquery = Note.objects.filter(
-            tree_id=OuterRef('tree_id'),
-            parent__isnull=True,
-            author=user,
-        ).values('order')[:1]
-
-        return (
-            Note.objects
-            .filter(author=user)
-            .annotate(root_order=Subquery(root_order_subquery))
-            .order_by('root_order', 'lft')
-        )
+        return notes.order_by('root_order', 'tree_id', 'lft')
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if request.query_params.get('format') == 'tree':
+            return Response(nest_notes(NoteSerializer.serialize_values(queryset)))
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(NoteSerializer.serialize_values(queryset))
 
     def perform_create(self, serializer):
         if serializer.is_valid():
@@ -34,32 +77,185 @@ class NoteListCreate(generics.ListCreateAPIView):
         else:
             print(serializer.errors)
 
-class NoteDelete(generics.DestroyAPIView):
+def parse_sync_cursor(value):
+    """The instant a sync cursor stands for; ValueError for anything that is not a cursor."""
+    try:
+        return SYNC_EPOCH + timedelta(microseconds=int(value))
+    except OverflowError:
+        raise ValueError(value)
+
+
+def note_changes(user_id, since=None):
+    """Active notes of a user changed, deleted and archived after ``since``, with the cursor to resume from.
+
+    Without ``since``, or with one older than the tombstone retention window,
+    every active note is returned with ``reset`` set. Notes of a category
+    deleted after ``since`` are listed as deleted before api.purge has left
+    their tombstones.
+    """
+    # Rows stamped within the margin before this read are sent again next time; clients apply them idempotently
+    cursor = timezone.now() - SYNC_COMMIT_MARGIN
+    notes = Note.objects.in_active_categories().filter(author_id=user_id, archived_at__isnull=True)
+    deleted = []
+    archived = []
+    reset = True
+    # Tombstones older than the retention window are gone, so such clients get a full snapshot
+    if since is not None and since >= cursor - NoteTombstone.RETENTION:
+        reset = False
+        notes = notes.filter(updated_at__gt=since)
+        deleted = NoteTombstone.objects.filter(author_id=user_id, deleted_at__gt=since).values_list('note_id', flat=True)
+        purging = Note.objects.filter(author_id=user_id, category__archived_at__gt=since).values_list('id', flat=True)
+        deleted = sorted({*deleted, *purging})
+        archived = Note.objects.in_active_categories().filter(author_id=user_id, archived_at__gt=since).values_list('id', flat=True)
+    return {
+        'notes': NoteSerializer(notes.order_by('tree_id', 'lft'), many=True).data,
+        'deleted': list(deleted),
+        'archived': list(archived),
+        'reset': reset,
+        'cursor': str((cursor - SYNC_EPOCH) // timedelta(microseconds=1)),
+    }
+
+
+class ArchivedNoteList(ConditionalGetMixin, generics.ListAPIView):
+    """Completed notes archived out of the notes list, in list order, a page at a time."""
+    serializer_class = NoteSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = ArchivedNotePagination
+
+    def get_queryset(self):
+        notes = Note.objects.in_active_categories().filter(author=self.request.user, archived_at__isnull=False)
+        notes = filter_by_category(notes, self.request.query_params)
+        return notes.order_by('root_order', 'tree_id', 'lft')
+
+
+class NoteSync(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since = parse_sync_cursor(since)
+            except ValueError:
+                return Response({"error": "since must be a cursor returned by this endpoint"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(note_changes(request.user.id, since or None))
+
+class NoteSearch(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    default_limit = 20
+    max_limit = 100
+
+    def get(self, request, *args, **kwargs):
+        terms = search_terms(request.query_params.get('q', ''))
+        if not terms:
+            raise ValidationError({"q": ["Enter at least one word to search for."]})
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.default_limit)), self.max_limit))
+            offset = max(0, int(request.query_params.get('offset', 0)))
+        except ValueError:
+            raise ValidationError({"limit": ["limit and offset must be integers."]})
+
+        # One row past the page tells whether there is a next one
+        hits = search_notes(request.user.id, terms, limit + 1, offset)
+        page = hits[:limit]
+        notes = {row['id']: row for row in NoteSerializer.serialize_values(Note.objects.filter(id__in=[hit[0] for hit in page]))}
+        results = []
+        for note_id, rank, path in page:
+            if note_id in notes:
+                results.append({**notes[note_id], 'rank': rank, 'path': path})
+
+        next_link = None
+        if len(hits) > limit:
+            next_link = replace_query_param(request.build_absolute_uri(), 'limit', limit)
+            next_link = replace_query_param(next_link, 'offset', offset + limit)
+        return Response({'next': next_link, 'results': results})
+
+class NoteBatchUpdate(VersionedWriteMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        operations = request.data.get('operations')
+        if not isinstance(operations, list):
+            return Response({"error": "operations must be a list"}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = NoteBatchOperationSerializer(data=operations, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        batch = NoteBatch(request.user, serializer.validated_data)
+        notes = batch.apply()
+        return Response({
+            'notes': NoteSerializer(notes, many=True).data,
+            'deleted': sorted(batch.deleted),
+            'temp_ids': {temp_id: note.id for temp_id, note in batch.temp_ids.items() if note.id is not None},
+        })
+
+class NoteDelete(VersionedWriteMixin, generics.DestroyAPIView):
     serializer_class = NoteSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         user = self.request.user
-        return Note.objects.filter(author=user)
+        return Note.objects.in_active_categories().filter(author=user)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            NoteTombstone.record(instance.get_descendants(include_self=True))
+            instance.delete()
 
-class NoteUpdate(generics.UpdateAPIView):
+class NoteUpdate(VersionedWriteMixin, generics.UpdateAPIView):
     serializer_class = NoteSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         user = self.request.user
-        return Note.objects.filter(author=user)
+        return Note.objects.in_active_categories().filter(author=user)
+
+class NoteMove(VersionedWriteMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated]
 
-class NoteOrderUpdate(APIView):
+    def post(self, request, pk, *args, **kwargs):
+        serializer = NoteMoveSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        parent_id = serializer.validated_data['parent']
+        category_id = serializer.validated_data.get('category')
+
+        with transaction.atomic():
+            # Lock only the moved note's tree and the target tree
+            notes = Note.objects.lock_trees(request.user, {pk, parent_id} - {None})
+            note = notes.get(pk)
+            if note is None:
+                raise NotFound()
+            parent = None
+            if parent_id is not None:
+                parent = notes.get(parent_id)
+                if parent is None:
+                    raise ValidationError({"parent": ["Invalid pk \"%s\" - object does not exist." % parent_id]})
+                if parent.pk == note.pk or parent.is_descendant_of(note):
+                    raise ValidationError({"parent": ["A note cannot be moved under itself."]})
+                if category_id is not None and category_id != parent.category_id:
+                    raise ValidationError({"parent": ["Parent must be in the same category."]})
+                # Notes of a deleted category stay until they are purged, but nothing may be moved there
+                if not Category.objects.active().filter(pk=parent.category_id).exists():
+                    raise ValidationError({"parent": ["Invalid pk \"%s\" - object does not exist." % parent_id]})
+            elif category_id is not None and not Category.objects.active().filter(pk=category_id, user=request.user).exists():
+                raise ValidationError({"category": ["Invalid pk \"%s\" - object does not exist." % category_id]})
+
+            Note.objects.move_subtree(note, parent, serializer.validated_data.get('position'), category_id)
+        return Response(NoteSerializer(note).data)
+
+class NoteOrderUpdate(VersionedWriteMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
         ordering = request.data.get('ordering', [])
-        for order, note_id in enumerate(ordering, start=1):  # Start from 1 instead of 0
-            Note.objects.filter(id=note_id, author=request.user).update(order=order)
+        if not isinstance(ordering, list) or not all(isinstance(note_id, int) for note_id in ordering):
+            return Response({"error": "ordering must be a list of note ids"}, status=status.HTTP_400_BAD_REQUEST)
+
+        Note.objects.reorder_roots(request.user, ordering)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class NoteResetOrder(APIView):
+class NoteResetOrder(VersionedWriteMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
@@ -67,20 +263,16 @@ class NoteResetOrder(APIView):
         if not category_id:
             return Response({"error": "category_id is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        notes = Note.objects.filter(category_id=category_id, author=request.user).order_by('created_at')
-        for order, note in enumerate(notes, start=1):  # Start from 1 here as well
-            note.order = order
-            note.save()
-
+        Note.objects.reset_root_order(request.user, category_id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class CategoryListCreate(generics.ListCreateAPIView):
+class CategoryListCreate(ConditionalGetMixin, VersionedWriteMixin, generics.ListCreateAPIView):
     serializer_class = CategorySerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         user = self.request.user
-        return Category.objects.filter(user=user)
+        return Category.objects.active().filter(user=user)
 
     def perform_create(self, serializer):
         if serializer.is_valid():
@@ -88,42 +280,81 @@ class CategoryListCreate(generics.ListCreateAPIView):
         else:
             print(serializer.errors)
 
-class CategoryDelete(generics.DestroyAPIView):
+class CategoryDelete(VersionedWriteMixin, generics.DestroyAPIView):
     serializer_class = CategorySerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         user = self.request.user
-        return Category.objects.filter(user=user)
+        return Category.objects.active().filter(user=user)
 
-class CategoryUpdate(generics.UpdateAPIView):
+    def perform_destroy(self, instance):
+        # Archived right away; api.purge deletes the notes tree by tree in the background
+        instance.archived_at = timezone.now()
+        instance.save(update_fields=['archived_at'])
+        schedule_category_purge(instance)
+
+class CategoryUpdate(VersionedWriteMixin, generics.UpdateAPIView):
     serializer_class = CategorySerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         user = self.request.user
-        return Category.objects.filter(user=user)
+        return Category.objects.active().filter(user=user)
+
+class ChecklistExport(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        records = export_records(request.user)
+        if request.query_params.get('format') == 'json':
+            response = StreamingHttpResponse(json_chunks(records), content_type='application/json')
+            response['Content-Disposition'] = 'attachment; filename="checklists.json"'
+        else:
+            response = StreamingHttpResponse(ndjson_lines(records), content_type='application/x-ndjson')
+            response['Content-Disposition'] = 'attachment; filename="checklists.ndjson"'
+        return response
+
+class ChecklistImport(VersionedWriteMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        # Read the body straight from the stream: NDJSON line by line, or one JSON array
+        stream = request.stream
+        if stream is None:
+            raise ValidationError({"records": ["The request body is empty."]})
+        if request.content_type.startswith('application/json'):
+            try:
+                records = json.load(stream)
+            except ValueError:
+                raise ValidationError({"records": ["Invalid JSON."]})
+            if not isinstance(records, list):
+                raise ValidationError({"records": ["Expected a JSON array of records."]})
+        else:
+            records = parse_ndjson(stream)
+        result = ChecklistImporter(request.user).run(records)
+        return Response(result, status=status.HTTP_201_CREATED)
 
 class CreateUserView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserCreateSerializer
     permission_classes = [permissions.AllowAny]
 
-class UserDetailView(generics.RetrieveAPIView):
+class UserDetailView(ConditionalGetMixin, generics.RetrieveAPIView):
     serializer_class = UserCreateSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
         return self.request.user
 
-class UserUpdateView(generics.UpdateAPIView):
+class UserUpdateView(VersionedWriteMixin, generics.UpdateAPIView):
     serializer_class = UserUpdateSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
         return self.request.user
 
-class ChangePasswordView(APIView):
+class ChangePasswordView(VersionedWriteMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
@@ -153,23 +384,12 @@ class PresenceHeartbeat(APIView):
         user_agent = request.headers.get('User-Agent', '')[:255]
         ip_address = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0] or request.META.get('REMOTE_ADDR')
 
-        if not visitor_id:
-            return Response({"error": "visitor_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+        error = visitor_id_error(visitor_id)
+        if error is not None:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
 
-        defaults = {
-            'user': request.user if request.user.is_authenticated else None,
-            'user_agent': user_agent,
-            'ip_address': ip_address,
-        }
-
-        visitor, created = VisitorPresence.objects.get_or_create(visitor_id=visitor_id, defaults=defaults)
-
-        # Update association if user logs in later
-        if request.user.is_authenticated and visitor.user != request.user:
-            visitor.user = request.user
-        visitor.user_agent = user_agent
-        visitor.ip_address = ip_address
-        visitor.touch()
+        user_id = request.user.id if request.user.is_authenticated else None
+        get_presence_store().record(visitor_id, user_id, user_agent, ip_address)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -180,26 +400,11 @@ class PresenceStats(APIView):
     ONLINE_WINDOW_SECONDS = 60
 
     def get(self, request, *args, **kwargs):
-        now = timezone.now()
-        threshold = now - timedelta(seconds=self.ONLINE_WINDOW_SECONDS)
-        recent_qs = VisitorPresence.objects.filter(last_seen__gte=threshold)
-        online_authenticated_users = recent_qs.exclude(user__isnull=True).values_list('user', flat=True).distinct().count()
-        online_anonymous_visitors = recent_qs.filter(user__isnull=True).count()
-        online_count = online_authenticated_users + online_anonymous_visitors
+        return Response(get_presence_stats(self.ONLINE_WINDOW_SECONDS))
 
-        total_visitors = VisitorPresence.objects.count()
-        total_users_ever = VisitorPresence.objects.exclude(user__isnull=True).values_list('user', flat=True).distinct().count()
 
-        return Response({
-            'online': online_count,
-            'total': total_visitors,
-            'online_breakdown': {
-                'authenticated_users': online_authenticated_users,
-                'anonymous_visitors': online_anonymous_visitors,
-            },
-            'totals': {
-                'unique_visitors': total_visitors,
-                'unique_authenticated_users': total_users_ever,
-            },
-            'window_seconds': self.ONLINE_WINDOW_SECONDS,
-        })
\ No newline at end of file
+class RequestMetricsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(request_metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,53 @@
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+
+class BackgroundWorkers:
+    """Runs ``task(argument)`` on a pool of ``max_workers`` threads off the request thread.
+
+    With ``max_workers`` set to 0 tasks run in the calling thread instead, and
+    their errors propagate; that is for tests and management commands. A
+    failed pooled task is logged with ``failure``, a format string taking the
+    argument, on the task module's logger; each pooled task releases its
+    thread's database connection.
+    """
+
+    def __init__(self, task, max_workers, name, failure):
+        self.task = task
+        self.failure = failure
+        self.logger = logging.getLogger(task.__module__)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-worker') if max_workers else None
+
+    def submit(self, argument):
+        if self.executor is None:
+            self.task(argument)
+        else:
+            self.executor.submit(self.run, argument)
+
+    def run(self, argument):
+        try:
+            self.task(argument)
+        except Exception:
+            self.logger.exception(self.failure, argument)
+        finally:
+            close_old_connections()
+
+
+def process_singleton(build):
+    """Decorator turning ``build()`` into a getter that builds once per process, on first use."""
+    instance = None
+    lock = threading.Lock()
+
+    @functools.wraps(build)
+    def get():
+        nonlocal instance
+        if instance is None:
+            with lock:
+                if instance is None:
+                    instance = build()
+        return instance
+    return get
@@ -29,7 +29,7 @@ ALLOWED_HOSTS = [
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "api.authentication.CachedJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -104,6 +105,81 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        # Per-process memory by default; point at a file path or a shared cache to share it between workers
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'cl-back'),
+    },
+    # Buffered heartbeats and the presence stats snapshot. Every worker must see the same queue, so anything
+    # beyond a single process needs a shared backend with atomic incr, such as
+    # PRESENCE_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache and PRESENCE_CACHE_LOCATION=redis://...
+    # The per-process default holds one entry per visitor active in the last day, so it is sized well past
+    # locmem's usual 300 entries; culling it drops heartbeats until their visitor beats again
+    'presence': {
+        'BACKEND': os.environ.get('PRESENCE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('PRESENCE_CACHE_LOCATION', 'cl-back-presence'),
+    },
+}
+if CACHES['presence']['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache':
+    CACHES['presence']['OPTIONS'] = {'MAX_ENTRIES': int(os.environ.get('PRESENCE_CACHE_MAX_ENTRIES', '100000'))}
+
+# Users resolved from JWTs are kept here, with their profile but not their password hash, for AUTH_USER_CACHE_TTL
+# seconds. Saves of a User or Profile drop the entry in this process; with several workers use a shared cache
+AUTH_USER_CACHE = 'default'
+AUTH_USER_CACHE_TTL = int(os.environ.get('AUTH_USER_CACHE_TTL', '60'))
+
+# Heartbeats are coalesced in the cache and written to VisitorPresence every PRESENCE_FLUSH_INTERVAL seconds.
+# Use api.presence.DatabasePresenceStore to write every heartbeat directly. With a shared PRESENCE_CACHE the
+# interval can be set to 0 and "manage.py flush_presence" run periodically instead of the in-process flusher;
+# with the per-process default only the app's own flusher can see the buffered heartbeats.
+PRESENCE_STORE = os.environ.get('PRESENCE_STORE', 'api.presence.CachePresenceStore')
+PRESENCE_CACHE = 'presence'
+PRESENCE_FLUSH_INTERVAL = int(os.environ.get('PRESENCE_FLUSH_INTERVAL', '10'))
+# Presence stats are recomputed at most once per this many seconds and shared through PRESENCE_CACHE
+PRESENCE_STATS_TTL = int(os.environ.get('PRESENCE_STATS_TTL', '5'))
+# "manage.py compact_presence" rolls older VisitorPresence rows into daily aggregates and deletes them
+PRESENCE_RETENTION_DAYS = int(os.environ.get('PRESENCE_RETENTION_DAYS', '30'))
+
+# Writes wake the user's /api/notes/events/ streams through this broker. api.events.LocalBroker only reaches
+# streams in the same process; a broker on shared pub/sub is needed once there is more than one worker
+EVENT_BROKER = os.environ.get('EVENT_BROKER', 'api.events.LocalBroker')
+# Seconds between keepalive comments on an idle event stream, and the reconnect delay sent to clients
+EVENT_STREAM_KEEPALIVE = int(os.environ.get('EVENT_STREAM_KEEPALIVE', '15'))
+EVENT_STREAM_RETRY_MS = 5000
+
+# Uploaded profile pictures are stripped of their metadata and resized into these square sizes, in this format,
+# by a background pool of PROFILE_PICTURE_WORKERS threads (0 processes them inline after the request's transaction
+# commits). Until then an upload waits under a random name in media/profile_pictures/pending/ and is not linked
+PROFILE_PICTURE_SIZES = (64, 128, 256)
+PROFILE_PICTURE_FORMAT = 'WEBP'
+PROFILE_PICTURE_QUALITY = 80
+PROFILE_PICTURE_WORKERS = int(os.environ.get('PROFILE_PICTURE_WORKERS', '2'))
+
+# Deleted categories are archived at once and their notes purged by a background pool of CATEGORY_PURGE_WORKERS
+# threads (0 purges inline after the request's transaction commits), whole trees at a time, in transactions of
+# about CATEGORY_PURGE_BATCH notes. "manage.py purge_categories" finishes purges cut short by a restart
+CATEGORY_PURGE_WORKERS = int(os.environ.get('CATEGORY_PURGE_WORKERS', '1'))
+CATEGORY_PURGE_BATCH = int(os.environ.get('CATEGORY_PURGE_BATCH', '1000'))
+
+# "manage.py archive_notes" moves subtrees whose notes are all scratched out and untouched for this many days
+# out of the notes list; they stay available from /api/notes/archived/
+NOTE_ARCHIVE_AFTER_DAYS = int(os.environ.get('NOTE_ARCHIVE_AFTER_DAYS', '30'))
+
+# The stack gunicorn runs, see gunicorn.conf.py. With "asgi" the notes list and presence endpoints are routed to
+# the async views in api.async_views; with "wsgi" they stay on the sync views, which serve them without thread hops
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+
+# Share of requests timed by api.middleware.RequestMetricsMiddleware (Server-Timing header, /api/metrics/);
+# 0 removes the middleware entirely. Raise it while profiling; timed requests expose their query counts
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.01'))
+# Sampled requests slower than this many milliseconds are logged as warnings
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', '500'))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
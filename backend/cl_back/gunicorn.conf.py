@@ -0,0 +1,16 @@
+# Read by gunicorn from the working directory. SERVER_MODE picks the stack:
+#   wsgi (default) - sync workers serving cl_back.wsgi
+#   asgi           - uvicorn workers serving cl_back.asgi; the presence and notes list
+#                    views then run on the event loop, so one worker holds thousands
+#                    of idle polling connections, and /api/notes/events/ is served
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
+if os.environ.get('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'cl_back.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+    keepalive = 75
+else:
+    wsgi_app = 'cl_back.wsgi:application'